@@ -0,0 +1,146 @@
+"""Offline benchmarks of both downloaders and both build tools, against the local stand-in server."""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.stand_in_server import StandInBook, start_server
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the downloaders and the build tools offline.")
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--segments", type=int, default=20)
+    parser.add_argument("--page-size", default="1200x1600", help="Size of the pages in pixels (default: 1200x1600).")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds before each response (default: 0.02).")
+    parser.add_argument("--bandwidth", type=float, help="Bytes per second per response (default: unlimited).")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of the page and segment requests that fail with a 503 (default: 0).")
+    parser.add_argument("--workers", type=int, default=8, help="Workers of the PDF downloader (default: 8).")
+    parser.add_argument("--max-rps", type=float, default=0, help="Request budget of the downloaders (default: unlimited).")
+    parser.add_argument("--jobs", type=int, default=1, help="Processes of the PDF build (default: 1).")
+    parser.add_argument("--json", dest="json_path", help="Write the results to this file.")
+    parser.add_argument("--baseline", help="Results of a previous run. Fail if a benchmark got slower than the tolerance.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed throughput drop compared to the baseline (default: 0.2, i.e. 20%%).")
+    parser.add_argument("--keep", action="store_true", help="Keep the working folder with the outputs and the logs.")
+    args = parser.parse_args()
+
+    width, height = map(int, args.page_size.split("x"))
+    print(f"Generating a book with {args.pages} pages of {width}x{height} and {args.segments} segments...")
+    book = StandInBook(pages=args.pages, segments=args.segments, page_size=(width, height))
+    server = start_server(book, latency=args.latency, bandwidth=args.bandwidth, error_rate=args.error_rate)
+
+    work_dir = tempfile.mkdtemp(prefix="play-book-benchmarks-")
+    with open(os.path.join(work_dir, "curl.txt"), "w") as f:
+        f.write(f"curl '{server.base_url}/books' -H 'User-Agent: benchmarks' -b 'SID=stand-in'")
+    book_dir = os.path.join(work_dir, "books", book.book_id)
+
+    benchmarks = [
+        ("download-pdf", [os.path.join(REPOSITORY_DIR, "google-play-book-downloader-pdf.py"), book.book_id,
+                          "--workers", str(args.workers), "--max-rps", str(args.max_rps)],
+         lambda: len(book.pages), lambda: None),
+        ("download-epub", [os.path.join(REPOSITORY_DIR, "google-play-book-downloader-epub.py"), book.book_id,
+                           "--max-rps", str(args.max_rps)],
+         lambda: len(book.segments), lambda: None),
+        ("build-pdf", ["-m", "play_book_pdf_tool.play_book_pdf_tool", os.path.join("books", book.book_id),
+                       "--jobs", str(args.jobs)],
+         lambda: len(book.pages), lambda: files_size(book_dir, (".png", ".jpeg"))),
+        ("build-epub", [os.path.join(REPOSITORY_DIR, "play_book_epub_tool.py"), book.book_id],
+         lambda: len(book.segments), lambda: files_size(book_dir, (".xhtml", ".css"))),
+    ]
+
+    env = {**os.environ, "PLAY_BOOKS_BASE_URL": server.base_url,
+           "PYTHONPATH": os.pathsep.join(filter(None, [REPOSITORY_DIR, os.environ.get("PYTHONPATH")]))}
+
+    results = {}
+    try:
+        for name, command, count_items, count_input_bytes in benchmarks:
+            bytes_sent = server.bytes_sent
+            result = run_tool(name, [sys.executable, *command], work_dir, env)
+            # Downloads are measured by the bytes transferred, builds by the bytes of their input files
+            transferred = count_input_bytes()
+            if transferred is None:
+                transferred = server.bytes_sent - bytes_sent
+            result["items_per_second"] = count_items() / result["seconds"]
+            result["mb_per_second"] = transferred / 1024 / 1024 / result["seconds"]
+            results[name] = result
+            print_result(name, result)
+    finally:
+        server.shutdown()
+        if args.keep:
+            print(f"Outputs and logs kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(results, f, indent=4)
+
+    failed = [name for name, result in results.items() if result["returncode"] != 0]
+    if args.baseline:
+        failed += compare_to_baseline(results, args.baseline, args.tolerance)
+    if failed:
+        print(f"Failed: {', '.join(failed)}")
+        sys.exit(1)
+
+
+def run_tool(name, command, cwd, env):
+    """Run the command and return its wall time, exit code and peak RSS (None where it can't be measured)."""
+    with open(os.path.join(cwd, f"{name}.log"), "w") as log_file:
+        start_time = time.perf_counter()
+        process = subprocess.Popen(command, cwd=cwd, env=env, stdout=log_file, stderr=subprocess.STDOUT,
+                                   stdin=subprocess.DEVNULL)
+
+        if hasattr(os, "wait4"):
+            # Unlike RUSAGE_CHILDREN, wait4() gives the peak RSS of this process only
+            _pid, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            # Linux reports kilobytes, macOS reports bytes
+            peak_rss = rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+        else:
+            process.wait()
+            peak_rss = None
+
+        seconds = time.perf_counter() - start_time
+
+    return {"seconds": seconds, "returncode": process.returncode, "peak_rss_bytes": peak_rss}
+
+
+def files_size(directory, extensions):
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith(extensions))
+
+
+def print_result(name, result):
+    peak_rss = f"{result['peak_rss_bytes'] / 1024 / 1024:.0f} MB" if result["peak_rss_bytes"] else "unknown"
+    status = "" if result["returncode"] == 0 else f" (FAILED with exit code {result['returncode']})"
+    print(f"{name:>14}: {result['seconds']:7.2f}s  {result['items_per_second']:8.1f} items/s  "
+          f"{result['mb_per_second']:7.1f} MB/s  peak RSS {peak_rss}{status}")
+
+
+def compare_to_baseline(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        minimum = baseline[name]["items_per_second"] * (1 - tolerance)
+        if result["items_per_second"] < minimum:
+            print(f"{name}: {result['items_per_second']:.1f} items/s is below the baseline "
+                  f"({baseline[name]['items_per_second']:.1f} items/s, minimum {minimum:.1f} items/s)")
+            regressions.append(name)
+
+    return regressions
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""Local stand-in for the Google Play Books endpoints used by the downloaders, serving a generated book."""
+
+import argparse
+import base64
+import hashlib
+import io
+import json
+import os
+import random
+import struct
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from Cryptodome.Cipher import AES
+from PIL import Image, ImageDraw
+
+BOOK_ID = "BENCHBOOK000"
+
+
+class StandInBook:
+    """A generated book with its AES key, and all its payloads already encrypted."""
+
+    def __init__(self, book_id=BOOK_ID, pages=50, segments=10, page_size=(1200, 1600), seed=0):
+        self.book_id = book_id
+        self.random = random.Random(seed)
+        self.aes_key = bytes(self.random.randrange(256) for _ in range(16))
+
+        self.pages = {}
+        for n in range(1, pages + 1):
+            # PP1 is the cover, which play_book_epub_tool.py expects as PP1.jpeg
+            pid = "PP1" if n == 1 else f"PA{n}"
+            content_type, image = ("image/jpeg", self.photo(page_size)) if n == 1 else ("image/png", self.text_page(page_size))
+            self.pages[pid] = (content_type, self.encrypt_page(image))
+
+        self.resources = {
+            "ornament.png": self.png(Image.new("L", (64, 64), 128)),
+            **{f"figure-{n}.png": self.text_page((320, 240)) for n in range(segments)},
+        }
+
+        self.segments = {}
+        for n in range(segments):
+            content = "".join(f"<p>{self.sentence()}</p>" for _ in range(40))
+            content = (f'<h1>Chapter {n + 1}</h1><img src="{{base_url}}/books/resource/ornament.png">{content}'
+                       f'<img src="{{base_url}}/books/resource/figure-{n}.png">')
+            self.segments[str(n)] = {"content": content, "style": "p { text-indent: 1em; } h1 { text-align: center; }"}
+
+        self.toc = [{"label": f"Chapter {n + 1}", "depth": 0, "page_index": n * pages // segments}
+                    for n in range(segments)]
+
+    def text_page(self, size):
+        """Black text-like lines on a white background, compresses about as well as a scanned page."""
+        image = Image.new("L", size, 255)
+        draw = ImageDraw.Draw(image)
+        width, height = size
+        for y in range(height // 20, height - height // 20, max(1, height // 40)):
+            x = width // 12
+            while x < width - width // 12:
+                word = self.random.randrange(width // 40, width // 8)
+                draw.rectangle((x, y, min(x + word, width - width // 12), y + max(1, height // 120)), fill=0)
+                x += word + width // 60
+        return self.png(image)
+
+    def photo(self, size):
+        image = Image.effect_noise(size, 64).convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=85)
+        return buffer.getvalue()
+
+    @staticmethod
+    def png(image):
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    def sentence(self):
+        return " ".join("".join(self.random.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(self.random.randrange(2, 10)))
+                        for _ in range(self.random.randrange(8, 20)))
+
+    def encrypt_page(self, data):
+        iv = os.urandom(16)
+        padding = b"\0" * (-len(data) % 16)
+        return iv + AES.new(self.aes_key, AES.MODE_CBC, iv).encrypt(data + padding)
+
+    def encrypt_segment(self, segment):
+        data = json.dumps(segment).encode("utf-8")
+        iv = os.urandom(16)
+        padding = b" " * (-len(data) % 16)
+        encrypted = iv + struct.pack("<I", len(data)) + AES.new(self.aes_key, AES.MODE_CBC, iv).encrypt(data + padding)
+        return base64.b64encode(encrypted)
+
+    def encoded_key(self):
+        """Inverse of decipher_key(): 128 groups of letters followed by a digit, one group per bit of the key."""
+        bits = []
+        for byte in self.aes_key:
+            bits += reversed(format(byte, "08b"))
+        # decipher_key() rotates the bits by 64, which is its own inverse for 128 bits
+        bits = bits[64:] + bits[:64]
+        # The bit is 1 when the letter at the index given by the digit is the same as the last letter
+        groups = "".join("xyz2" if bit == "1" else "xyz0" for bit in bits)
+        return base64.b64encode(groups.encode()).decode()
+
+    def reader_page(self):
+        return (f'<!DOCTYPE html><html><head><script>var _OC_contentInfo = {{"toc_entry": {json.dumps(self.toc)}}};'
+                f'</script></head><body><div class="reader"><img src="data:image/png;base64,{self.encoded_key()}">'
+                f'</div></body></html>').encode("utf-8")
+
+    def manifest(self, base_url):
+        return json.dumps({
+            "metadata": {"title": "Stand-in Book", "authors": "Jane Doe, John Doe", "publisher": "Benchmarks",
+                         "pub_date": "2020.01.01", "preview": "full", "volume_id": self.book_id,
+                         "num_pages": len(self.pages)},
+            "language": "en",
+            "default_size": {"width": 600, "height": 800},
+            "page": [{"pid": pid, "src": f"{base_url}/books/content?id={self.book_id}&pg={pid}"} for pid in self.pages],
+            "segment": [{"label": f"seg{n}", "title": f"Chapter {int(n) + 1}", "order": int(n),
+                         "link": f"/books/segment?id={self.book_id}&s={n}"} for n in self.segments],
+            "toc_entry": self.toc,
+        }).encode("utf-8")
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, book, port=0, latency=0.0, bandwidth=None, error_rate=0.0):
+        super().__init__(("127.0.0.1", port), StandInRequestHandler)
+        self.book = book
+        self.latency = latency  # Seconds before each response
+        self.bandwidth = bandwidth  # Bytes per second per response, None for unlimited
+        self.error_rate = error_rate  # Fraction of the page and segment requests answered with a 503
+        self.bytes_sent = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like Google's servers
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        book = server.book
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        with server.lock:
+            server.requests += 1
+
+        time.sleep(server.latency)
+
+        content_type, body = "text/plain", None
+        if url.path == "/books/reader":
+            content_type, body = "text/html; charset=utf-8", book.reader_page()
+        elif url.path == f"/books/volumes/{book.book_id}/manifest":
+            content_type, body = "application/json; charset=utf-8", book.manifest(server.base_url)
+        elif url.path == "/books/content" and query.get("pg", [""])[0] in book.pages:
+            if random.random() < server.error_rate:
+                return self.send_body(503, "text/plain", b"Service Unavailable")
+            content_type, body = book.pages[query["pg"][0]]
+        elif url.path == "/books/segment" and query.get("s", [""])[0] in book.segments:
+            if random.random() < server.error_rate:
+                return self.send_body(503, "text/plain", b"Service Unavailable")
+            segment = book.segments[query["s"][0]]
+            segment = {**segment, "content": segment["content"].replace("{base_url}", server.base_url)}
+            body = book.encrypt_segment(segment)
+        elif url.path.startswith("/books/resource/") and url.path.rsplit("/", 1)[1] in book.resources:
+            content_type, body = "image/png", book.resources[url.path.rsplit("/", 1)[1]]
+
+        if body is None:
+            return self.send_body(404, "text/plain", b"Not Found")
+        if url.path == "/books/reader" or url.path.endswith("/manifest"):
+            # The metadata can be revalidated, like on Google's servers
+            etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+            if self.headers.get("If-None-Match") == etag:
+                return self.send_body(304, content_type, b"", {"ETag": etag})
+            return self.send_body(200, content_type, body, {"ETag": etag})
+        self.send_body(200, content_type, body)
+
+    def send_body(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        chunk_size = 64 * 1024
+        for start in range(0, len(body), chunk_size):
+            chunk = body[start:start + chunk_size]
+            self.wfile.write(chunk)
+            if self.server.bandwidth:
+                time.sleep(len(chunk) / self.server.bandwidth)
+
+        with self.server.lock:
+            self.server.bytes_sent += len(body)
+
+
+def start_server(book, port=0, latency=0.0, bandwidth=None, error_rate=0.0):
+    """Start the stand-in server in a background thread and return it (see StandInServer.base_url)."""
+    server = StandInServer(book, port, latency, bandwidth, error_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a generated book like Google Play Books would.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--pages", type=int, default=50)
+    parser.add_argument("--segments", type=int, default=10)
+    parser.add_argument("--page-size", default="1200x1600", help="Size of the pages in pixels (default: 1200x1600).")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before each response.")
+    parser.add_argument("--bandwidth", type=float, help="Bytes per second per response (default: unlimited).")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of the page and segment requests that fail with a 503.")
+    args = parser.parse_args()
+
+    width, height = map(int, args.page_size.split("x"))
+    book = StandInBook(pages=args.pages, segments=args.segments, page_size=(width, height))
+    server = StandInServer(book, args.port, args.latency, args.bandwidth, args.error_rate)
+
+    print(f"Serving the book {book.book_id} on {server.base_url}")
+    print(f"Use it with: PLAY_BOOKS_BASE_URL={server.base_url} and a curl.txt containing: curl '{server.base_url}/books' -b 'SID=stand-in'")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
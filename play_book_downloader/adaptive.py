@@ -0,0 +1,175 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from play_book_downloader.session import RateLimiter
+
+ADAPTIVE_STATE_FILE = "adaptive_rate.json"  # Learned rate of each account, reused by the next runs
+ADAPTIVE_INITIAL_RPS = 2  # Starting rate of an account that has no learned rate yet
+ADAPTIVE_MIN_RPS = 0.2
+ADAPTIVE_RPS_INCREASE = 0.5  # Requests per second added after each second of healthy responses
+ADAPTIVE_BACKOFF = 0.5  # Rate and concurrency are multiplied by this when throttled
+ADAPTIVE_LATENCY_SPIKE = 3  # A response this many times slower than the average latency counts as throttling
+ADAPTIVE_LATENCY_SAMPLES = 10  # Responses needed before latency spikes are detected
+THROTTLING_STATUSES = (429, 503)
+ACCOUNT_COOKIES = ("SID", "__Secure-1PSID", "__Secure-3PSID")  # Cookies that identify the Google account
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """Finds the fastest rate and the most parallel requests that Google Play Books accepts, with AIMD."""
+
+    def __init__(self, max_rps, max_concurrency, initial_rps=ADAPTIVE_INITIAL_RPS, initial_concurrency=1):
+        super().__init__(0)
+        self.max_rps = max_rps if max_rps > 0 else float("inf")
+        self.max_concurrency = max_concurrency
+        self.rps = min(max(initial_rps, ADAPTIVE_MIN_RPS), self.max_rps)
+        self.concurrency = min(max(initial_concurrency, 1), max_concurrency)
+        self.interval = 1 / self.rps
+        self.paused_until = 0
+
+        self.in_flight = 0
+        self.slots = threading.Condition()
+
+        self.latency = None  # Moving average of the latency of the healthy responses
+        self.latency_samples = 0
+        self.last_backoff = 0
+
+    @contextmanager
+    def request(self):
+        import requests
+
+        with self.slots:
+            while self.in_flight >= int(self.concurrency):
+                self.slots.wait()
+            self.in_flight += 1
+        try:
+            self.wait()
+            yield
+        except requests.HTTPError as e:
+            if e.response is not None:
+                self.observe(e.response)
+            raise
+        except requests.ConnectionError:
+            self.back_off("connection error")
+            raise
+        finally:
+            with self.slots:
+                self.in_flight -= 1
+                self.slots.notify_all()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, self.paused_until, now)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+    def observe(self, response):
+        history = response.raw.retries.history if response.raw is not None and response.raw.retries else ()
+        throttled = [entry.status for entry in history if entry.status in THROTTLING_STATUSES]
+        if response.status_code in THROTTLING_STATUSES:
+            throttled.append(response.status_code)
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        latency = response.elapsed.total_seconds()
+
+        if throttled or retry_after is not None:
+            self.back_off(f"status {', '.join(map(str, throttled)) or response.status_code}", retry_after)
+        elif (self.latency_samples >= ADAPTIVE_LATENCY_SAMPLES and
+              latency > ADAPTIVE_LATENCY_SPIKE * self.latency):
+            self.back_off(f"latency of {latency:.2f}s instead of {self.latency:.2f}s")
+        elif response.ok:
+            self.increase()
+
+        if response.ok:
+            with self.lock:
+                self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+                self.latency_samples += 1
+
+    def increase(self):
+        with self.lock:
+            # Adding increase/rps per response adds about `increase` per second
+            self.rps = min(self.rps + ADAPTIVE_RPS_INCREASE / self.rps, self.max_rps)
+            self.interval = 1 / self.rps
+        with self.slots:
+            self.concurrency = min(self.concurrency + 1 / self.concurrency, self.max_concurrency)
+            self.slots.notify_all()
+
+    def back_off(self, reason, retry_after=None):
+        with self.lock:
+            now = time.monotonic()
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            # The requests in flight when the server started throttling us all report it, only back off once for them
+            if now - self.last_backoff < max(1.0, 2 * (self.latency or 0)):
+                return
+            self.last_backoff = now
+            self.rps = max(self.rps * ADAPTIVE_BACKOFF, ADAPTIVE_MIN_RPS)
+            self.interval = 1 / self.rps
+        with self.slots:
+            self.concurrency = max(self.concurrency * ADAPTIVE_BACKOFF, 1)
+
+        pause = f", pausing for {retry_after:.0f}s" if retry_after else ""
+        logging.warning(f"Google Play Books is throttling the requests ({reason}). Slowing down to "
+                        f"{self.rps:.1f} requests/s and {int(self.concurrency)} in parallel{pause}")
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (either seconds or an HTTP date), or None."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def account_key(cookies):
+    """Identify the Google account of the cookies, without storing the cookies themselves."""
+    for name in ACCOUNT_COOKIES:
+        if cookies.get(name):
+            return hashlib.sha256(cookies[name].encode("utf-8")).hexdigest()[:16]
+    return "anonymous"
+
+
+def load_rate_limiter(cookies, max_rps, max_concurrency, state_path=ADAPTIVE_STATE_FILE):
+    """Create an AdaptiveRateLimiter that starts from the rate learned for this account by the previous runs."""
+    state = read_state(state_path).get(account_key(cookies), {})
+    rate_limiter = AdaptiveRateLimiter(max_rps, max_concurrency, state.get("rps", ADAPTIVE_INITIAL_RPS),
+                                       state.get("concurrency", 1))
+    if state:
+        logging.info(f"Starting at the learned rate of {rate_limiter.rps:.1f} requests/s "
+                     f"and {int(rate_limiter.concurrency)} in parallel")
+    return rate_limiter
+
+
+def save_rate_limiter(rate_limiter, cookies, state_path=ADAPTIVE_STATE_FILE):
+    """Remember the rate reached by the rate limiter for the next runs with the same account."""
+    state = read_state(state_path)
+    account = state.setdefault(account_key(cookies), {})
+    account["rps"] = round(rate_limiter.rps, 2)
+    if rate_limiter.max_concurrency > 1:  # Don't forget the concurrency learned by the PDF downloader in the EPUB one
+        account["concurrency"] = round(rate_limiter.concurrency, 2)
+    account["updated"] = datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+    temporary_path = f"{state_path}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=4)
+    os.replace(temporary_path, state_path)
+
+
+def read_state(state_path):
+    try:
+        with open(state_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
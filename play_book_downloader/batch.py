@@ -0,0 +1,67 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from play_book_downloader.metrics import MetricsRecorder, StageProfiler
+
+
+class BatchScheduler:
+    """Downloads several books at once with one HTTP session, one request budget and one pool of page workers."""
+
+    def __init__(self, session, rate_limiter, workers, parallel_books=1, metrics=None, profiler=None,
+                 credentials=None):
+        self.session = session
+        self.rate_limiter = rate_limiter
+        self.credentials = credentials
+        self.parallel_books = parallel_books
+        self.metrics = metrics or MetricsRecorder()
+        self.profiler = profiler or StageProfiler()
+        self.page_executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit_page(self, fn, *args):
+        return self.page_executor.submit(self.call, fn, *args)
+
+    def call(self, fn, *args):
+        """Call fn(*args), through the credential manager if there is one (see CredentialManager.call())."""
+        return self.credentials.call(fn, *args) if self.credentials else fn(*args)
+
+    def run(self, book_ids, download_book):
+        """Call download_book(book_id, scheduler) for each book and return their results by book ID."""
+        book_ids = list(dict.fromkeys(book_ids))  # Drop the duplicates but keep the order
+        results = {}
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.parallel_books) as book_executor:
+                futures = {book_executor.submit(download_book, book_id, self): book_id for book_id in book_ids}
+                for future in as_completed(futures):
+                    book_id = futures[future]
+                    try:
+                        results[book_id] = future.result()
+                    except Exception as e:
+                        logging.error(f"[{book_id}] Error! The download of the book failed with {e}")
+                        results[book_id] = {"error": str(e)}
+        finally:
+            self.page_executor.shutdown(cancel_futures=True)
+
+        return {book_id: results[book_id] for book_id in book_ids}
+
+
+def log_summary(results, unit="pages"):
+    """Log one line per book with the outcome of its download. Return True if all the books are complete."""
+    complete = True
+    lines = []
+
+    for book_id, result in results.items():
+        if result.get("error"):
+            complete = False
+            lines.append(f"  {book_id}: FAILED ({result['error']})")
+        elif result["downloaded"] < result["total"]:
+            complete = False
+            missing = result["total"] - result["downloaded"]
+            lines.append(f"  {book_id}: INCOMPLETE ({result['downloaded']}/{result['total']} {unit}, {missing} missing)")
+        else:
+            lines.append(f"  {book_id}: OK ({result['downloaded']}/{result['total']} {unit})")
+
+    log = logging.info if complete else logging.error
+    log("Summary:\n" + "\n".join(lines))
+
+    return complete
@@ -0,0 +1,248 @@
+import contextlib
+import hashlib
+import io
+import os
+import sqlite3
+import tempfile
+import threading
+import urllib.parse
+
+BOOK_STORE_FILENAME = "book.sqlite"
+BOOK_STORES = ("files", "sqlite")
+# Files written to book.sqlite are kept in memory up to this size, bigger ones go to a local temporary file first
+SQLITE_WRITE_BUFFER_SIZE = 1024 * 1024
+SQLITE_COPY_CHUNK_SIZE = 256 * 1024
+
+
+def open_book_store(book_dir, backend=None):
+    """Return the store of the book in book_dir."""
+    if backend is None:
+        backend = "sqlite" if os.path.exists(os.path.join(book_dir, BOOK_STORE_FILENAME)) else "files"
+    if backend == "sqlite":
+        return SqliteBookStore(book_dir)
+    if backend == "files":
+        return DirectoryBookStore(book_dir)
+    raise ValueError(f"Unknown book store '{backend}', expected one of: {', '.join(BOOK_STORES)}")
+
+
+class DirectoryBookStore:
+    """Stores the pages, the segments and the metadata of a book as files in the book folder."""
+
+    def __init__(self, book_dir):
+        self.book_dir = book_dir
+        os.makedirs(book_dir, exist_ok=True)
+
+    def open(self, name, mode="r"):
+        """Open the file for reading, or for writing as a context manager ("w" or "wb" modes)."""
+        if "w" in mode:
+            return self.write(name, mode)
+        return open(self.path(name), mode, encoding=None if "b" in mode else "utf-8")
+
+    @contextlib.contextmanager
+    def write(self, name, mode):
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.part", mode, encoding=None if "b" in mode else "utf-8") as f:
+            yield f
+        os.replace(f"{path}.part", path)
+
+    def read(self, name):
+        with open(self.path(name), "rb") as f:
+            return f.read()
+
+    def size(self, name):
+        """Return the size of the file in bytes. Raises OSError if it doesn't exist."""
+        return os.path.getsize(self.path(name))
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def sha256(self, name):
+        sha256 = hashlib.sha256()
+        with open(self.path(name), "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def version(self, name):
+        """Return something that changes when the file is written again, so that its hash isn't computed every time."""
+        stat = os.stat(self.path(name))
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def image(self, name):
+        """Return the image as the build tools take it (see read_image()): the path of its file."""
+        return self.path(name)
+
+    def path(self, name):
+        return os.path.join(self.book_dir, name)
+
+    def close(self):
+        pass
+
+
+class SqliteBookStore:
+    """Stores the pages, the segments and the metadata of a book in a single SQLite file, book.sqlite."""
+
+    def __init__(self, book_dir):
+        self.book_dir = book_dir
+        os.makedirs(book_dir, exist_ok=True)
+        self.database_path = os.path.join(book_dir, BOOK_STORE_FILENAME)
+        self.lock = threading.Lock()
+        # The pages are written by the download workers, the connection is shared between them behind the lock
+        self.connection = sqlite3.connect(self.database_path, check_same_thread=False)
+        with self.lock, self.connection:
+            # Not WAL, which needs shared memory that network file systems don't support
+            self.connection.execute("PRAGMA journal_mode=PERSIST")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, data BLOB NOT NULL, sha256 TEXT NOT NULL)")
+
+    def open(self, name, mode="r"):
+        """Open the file for reading, or for writing as a context manager ("w" or "wb" modes)."""
+        if "w" in mode:
+            return self.write(name, mode)
+        reader = open_blob(self.database_path, name)
+        return reader if "b" in mode else io.TextIOWrapper(io.BufferedReader(reader), encoding="utf-8")
+
+    @contextlib.contextmanager
+    def write(self, name, mode):
+        with tempfile.SpooledTemporaryFile(max_size=SQLITE_WRITE_BUFFER_SIZE) as buffer:
+            if "b" in mode:
+                yield buffer
+            else:
+                text = io.TextIOWrapper(buffer, encoding="utf-8")
+                yield text
+                text.flush()
+                text.detach()
+
+            size = buffer.tell()
+            buffer.seek(0)
+            sha256 = hashlib.sha256()
+            with self.lock, self.connection:
+                # The blob is allocated at its final size and then filled one chunk at a time
+                rowid = self.connection.execute(
+                    "INSERT OR REPLACE INTO files (name, data, sha256) VALUES (?, zeroblob(?), '')", (name, size)
+                ).lastrowid
+                with self.connection.blobopen("files", "data", rowid) as blob:
+                    for chunk in iter(lambda: buffer.read(SQLITE_COPY_CHUNK_SIZE), b""):
+                        blob.write(chunk)
+                        sha256.update(chunk)
+                self.connection.execute("UPDATE files SET sha256 = ? WHERE rowid = ?", (sha256.hexdigest(), rowid))
+
+    def read(self, name):
+        return self.fetch_one("SELECT data FROM files WHERE name = ?", name)
+
+    def size(self, name):
+        """Return the size of the file in bytes. Raises OSError if it doesn't exist."""
+        return self.fetch_one("SELECT length(data) FROM files WHERE name = ?", name)
+
+    def exists(self, name):
+        try:
+            self.size(name)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def sha256(self, name):
+        return self.fetch_one("SELECT sha256 FROM files WHERE name = ?", name)
+
+    def version(self, name):
+        """Return something that changes when the file is written again: its hash, computed when it was written."""
+        return self.sha256(name)
+
+    def image(self, name):
+        """Return the image as the build tools take it (see read_image()): a StoredImage, read when it's used."""
+        return StoredImage(self.database_path, name, self.size(name))
+
+    def path(self, name):
+        return f"{self.database_path}:{name}"
+
+    def fetch_one(self, query, name):
+        with self.lock:
+            row = self.connection.execute(query, (name,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"{name} isn't in {self.database_path}")
+        return row[0]
+
+    def close(self):
+        self.connection.close()
+
+
+class StoredImage:
+    """An image in a book.sqlite file, only read when it's used."""
+
+    def __init__(self, database_path, name, size):
+        self.database_path = database_path
+        self.name = name
+        self.size = size
+
+    @property
+    def path(self):
+        return f"{self.database_path}:{self.name}"
+
+    def open(self):
+        return open_blob(self.database_path, self.name)
+
+
+class BlobReader(io.RawIOBase):
+    """Reads a file of book.sqlite from its blob, with its own read-only connection (closed with the reader)."""
+
+    def __init__(self, connection, blob):
+        self.connection = connection
+        self.blob = blob
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.blob.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.blob.seek(offset, whence)
+        return self.blob.tell()
+
+    def tell(self):
+        return self.blob.tell()
+
+    def close(self):
+        if not self.closed:
+            self.blob.close()
+            self.connection.close()
+        super().close()
+
+
+def open_blob(database_path, name):
+    """Open the file of book.sqlite for reading as a binary stream. Raises FileNotFoundError if it isn't there."""
+    connection = sqlite3.connect(f"file:{urllib.parse.quote(database_path)}?mode=ro", uri=True)
+    try:
+        row = connection.execute("SELECT rowid FROM files WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"{name} isn't in {database_path}")
+        return BlobReader(connection, connection.blobopen("files", "data", row[0], readonly=True))
+    except BaseException:
+        connection.close()
+        raise
+
+
+def open_image(image):
+    """Open an image from the image() method of the book stores (a path or a StoredImage) as a binary stream."""
+    return open(image, "rb") if isinstance(image, str) else image.open()
+
+
+def read_image(image):
+    with open_image(image) as f:
+        return f.read()
+
+
+def image_size(image):
+    """Size in bytes of an image from the image() method of the book stores."""
+    return os.path.getsize(image) if isinstance(image, str) else image.size
+
+
+def image_name(image):
+    """Name of an image from the image() method of the book stores, for the logs."""
+    return image if isinstance(image, str) else image.path
@@ -0,0 +1,124 @@
+import logging
+import os
+import threading
+import time
+
+CURL_PATH = "curl.txt"
+# How long the downloads wait for new credentials in curl.txt once the current ones expired, before giving up
+CREDENTIALS_WAIT_TIMEOUT = 30 * 60
+CREDENTIALS_POLL_INTERVAL = 2  # Seconds between two checks of curl.txt while waiting for new credentials
+AUTH_FAILURE_STATUSES = (401, 403)
+
+
+class CredentialsExpired(Exception):
+    """Google Play Books answered with something that means that the cookies expired, e.g. the login page."""
+
+
+def is_auth_failure(error):
+    """Whether the exception raised by a request means that the credentials aren't valid anymore."""
+    if isinstance(error, CredentialsExpired):
+        return True
+    return getattr(getattr(error, "response", None), "status_code", None) in AUTH_FAILURE_STATUSES
+
+
+class CredentialManager:
+    """Keeps the cookies and headers of the session in sync with curl.txt, so that a long run survives their expiry."""
+
+    def __init__(self, session, read_credentials, curl_path=CURL_PATH, timeout=CREDENTIALS_WAIT_TIMEOUT,
+                 poll_interval=CREDENTIALS_POLL_INTERVAL):
+        self.session = session
+        self.read_credentials = read_credentials
+        self.curl_path = curl_path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.resumed = threading.Event()  # Cleared while the workers are paused
+        self.resumed.set()
+        self.generation = 0  # Incremented each time new credentials are loaded
+        self.gave_up = False
+        self.modified_time = self.curl_modified_time()
+
+    def call(self, fn, *args):
+        """Call fn(*args), and call it again with the new credentials if it failed because they expired."""
+        while True:
+            self.resumed.wait()
+            self.reload_if_changed()
+            generation = self.generation
+            try:
+                return fn(*args)
+            except Exception as e:
+                if not is_auth_failure(e) or not self.refresh(generation, str(e)):
+                    raise
+
+    def refresh(self, generation, reason):
+        """Wait until curl.txt has new credentials and load them. Return False if none came before the timeout."""
+        with self.lock:
+            if self.generation != generation:
+                return True
+            if self.gave_up:
+                return False
+            # The first worker to notice pauses the others and logs it, the ones already in flight wait too
+            first = self.resumed.is_set()
+            if first:
+                self.resumed.clear()
+                logging.error(f"The credentials in {self.curl_path} seem to have expired ({reason}). Copy a new cURL "
+                              f"command to {self.curl_path} (see the README), the download resumes as soon as it's "
+                              f"saved. Waiting for up to {self.timeout:.0f}s…")
+
+        try:
+            deadline = time.monotonic() + self.timeout
+            while time.monotonic() < deadline:
+                if self.has_new_credentials(generation):
+                    return True
+                if self.gave_up:
+                    return False
+                time.sleep(self.poll_interval)
+
+            with self.lock:
+                if self.generation != generation:
+                    return True
+                if not self.gave_up:
+                    logging.error(f"No new credentials in {self.curl_path} after {self.timeout:.0f}s, giving up")
+                self.gave_up = True
+                return False
+        finally:
+            if first:
+                self.resumed.set()
+
+    def has_new_credentials(self, generation):
+        """Return whether the credentials changed since generation, after loading curl.txt if it changed. Doesn't wait."""
+        self.reload_if_changed()
+        return self.generation != generation
+
+    def reload_if_changed(self, locked=False):
+        """Load the credentials of curl.txt into the session if it changed on disk. Return True if they were loaded."""
+        modified_time = self.curl_modified_time()
+        if modified_time == self.modified_time:
+            return False
+        if not locked:
+            with self.lock:
+                return self.reload_if_changed(locked=True)
+        if modified_time == self.modified_time:  # Loaded by another thread in the meantime
+            return False
+
+        try:
+            cookies, headers = self.read_credentials(self.curl_path)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Couldn't load the new credentials from {self.curl_path}: {e}")
+            self.modified_time = modified_time  # Wait for the next change
+            return False
+
+        self.session.cookies.clear()
+        self.session.cookies.update(cookies)
+        self.session.headers.update(headers)
+        self.modified_time = modified_time
+        self.generation += 1
+        self.gave_up = False
+        logging.info(f"Loaded the new credentials from {self.curl_path}")
+        return True
+
+    def curl_modified_time(self):
+        try:
+            return os.stat(self.curl_path).st_mtime_ns
+        except OSError:
+            return None
@@ -0,0 +1,419 @@
+import sys
+import json
+import base64
+import logging
+import re
+import hashlib
+import mimetypes
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse, urlencode, urlunparse, parse_qs
+
+from play_book_downloader.adaptive import save_rate_limiter
+from play_book_downloader.batch import BatchScheduler, log_summary
+from play_book_downloader.book_store import open_book_store, BOOK_STORES
+from play_book_downloader.credentials import CredentialsExpired, CREDENTIALS_WAIT_TIMEOUT, CURL_PATH
+from play_book_downloader.metrics import MetricsRecorder, StageProfiler, PROFILE_DIR
+from play_book_downloader.pdf import create_credential_manager, create_rate_limiter, read_book_list, \
+    read_curl_credentials
+from play_book_downloader.resource_cache import ResourceCache, RESOURCE_CACHE_MAX_BYTES
+from play_book_downloader.selection import is_selected, log_selection, parse_selection, priority_order
+from play_book_downloader.session import create_session, fetch, PLAY_BOOKS_BASE_URL
+
+GOOGLE_MAX_REQUESTS_PER_SECOND = 10  # Shared by all the books, to reduce risk of getting flagged for abuse
+# Maximum number of segments downloaded at the same time, for all the books. Unless --fixed-rate is used, the rate
+# limiter adapts the number of parallel requests to the responses of Google Play Books within this limit.
+GOOGLE_SEGMENT_DOWNLOAD_WORKERS = 4
+PARALLEL_BOOKS = 2  # Number of books downloaded at the same time
+# Images, fonts, etc. are downloaded once and kept in this folder. Defaults to books/[BOOK_ID]/resource-cache, set it to
+# a shared folder (e.g. "resource-cache") to also reuse the resources between books and between runs.
+RESOURCE_CACHE_DIR = None
+# By default the resources are embedded in the HTML of the segments as base64 data URIs. Set to False to instead save
+# them once as files in books/[BOOK_ID]/resources and reference them with relative paths (smaller and faster EPUBs).
+EMBED_RESOURCES_AS_BASE64 = True
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description="Download the segments of one or several Google Play Books as HTML. The PDF download needs to be run first for each book.")
+    parser.add_argument("book_ids", nargs="*", metavar="book_id",
+                        help="ID of the book, found in the URL of the book page. Asked interactively if omitted.")
+    parser.add_argument("--book-list", type=argparse.FileType("r", encoding="utf-8"),
+                        help="File with the IDs of the books to download, one per line.")
+    parser.add_argument("--parallel-books", type=int, default=PARALLEL_BOOKS,
+                        help=f"Number of books downloaded at the same time (default: {PARALLEL_BOOKS}).")
+    parser.add_argument("--max-rps", type=float, default=GOOGLE_MAX_REQUESTS_PER_SECOND,
+                        help=f"Maximum number of requests per second, for all the books (default: {GOOGLE_MAX_REQUESTS_PER_SECOND}).")
+    parser.add_argument("--workers", type=int, default=GOOGLE_SEGMENT_DOWNLOAD_WORKERS,
+                        help=f"Maximum number of segments downloaded in parallel, for all the books (default: {GOOGLE_SEGMENT_DOWNLOAD_WORKERS}).")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count(),
+                        help="Number of processes decrypting the segments and rewriting their HTML, shared by all the "
+                             "books (default: the number of CPUs).")
+    parser.add_argument("--fixed-rate", action="store_true",
+                        help="Always send --max-rps requests per second with --workers in parallel, instead of "
+                             "adapting the rate to the responses of Google Play Books.")
+    parser.add_argument("--credentials-timeout", type=float, default=CREDENTIALS_WAIT_TIMEOUT, metavar="SECONDS",
+                        help="When the cookies expire during the download, pause it and wait this long for a new cURL "
+                             f"command in {CURL_PATH} before giving up, 0 to fail right away (default: "
+                             f"{CREDENTIALS_WAIT_TIMEOUT}).")
+    parser.add_argument("--resource-cache-dir", default=RESOURCE_CACHE_DIR,
+                        help="Folder shared between books and runs where the resources are cached (default: books/[BOOK_ID]/resource-cache).")
+    parser.add_argument("--resource-files", dest="embed_resources_as_base64", action="store_false",
+                        default=EMBED_RESOURCES_AS_BASE64,
+                        help="Save the resources as files in books/[BOOK_ID]/resources instead of embedding them in the HTML as base64.")
+    parser.add_argument("--chapters", type=parse_selection, metavar="CHAPTERS",
+                        help="Only download these segments, given by their order (e.g. 3-5,8, the number at the start "
+                             "of their files in segments/) or by a part of their title (e.g. \"Introduction\").")
+    parser.add_argument("--priority", action="store_true",
+                        help="Download the segments selected by --chapters first, and then the rest of the book.")
+    parser.add_argument("--store", choices=BOOK_STORES,
+                        help="Save the segments as files in the folder of each book, or all together in a single "
+                             "book.sqlite file (faster on network storage). Defaults to the store the book already "
+                             "has, which is the one chosen for the PDF download.")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="Write metrics for each segment to FILE (JSON lines) and a Prometheus summary next to it.")
+    parser.add_argument("--profile", action="store_true",
+                        help=f"Profile each book with cProfile and tracemalloc, the results are saved in {PROFILE_DIR}/.")
+    args = parser.parse_args(argv)
+
+    book_ids = list(args.book_ids)
+    if args.book_list:
+        book_ids += read_book_list(args.book_list)
+    if not book_ids:
+        book_ids = [input("Type your book ID and press enter: ")]
+
+    logging.basicConfig(level=logging.INFO,
+                        format="[%(asctime)s] %(levelname)s: %(message)s")
+
+    cookies, headers = read_curl_credentials()
+
+    session = create_session(cookies, headers)
+    metrics = MetricsRecorder(args.metrics)
+    profiler = StageProfiler(PROFILE_DIR if args.profile else None, metrics)
+    rate_limiter = create_rate_limiter(cookies, args.max_rps, workers=args.workers, fixed_rate=args.fixed_rate)
+    scheduler = BatchScheduler(session, rate_limiter, workers=args.workers, parallel_books=args.parallel_books,
+                               metrics=metrics, profiler=profiler,
+                               credentials=create_credential_manager(session, args.credentials_timeout))
+
+    # A single pool for all the books, so that --parallel-books doesn't multiply the number of processes
+    processes = ProcessPoolExecutor(max_workers=args.jobs)
+    # Same for the resource cache, when it's shared by the books
+    resource_cache = ResourceCache(args.resource_cache_dir) if args.resource_cache_dir else None
+
+    def download(book_id, scheduler):
+        with scheduler.profiler.stage(f"{book_id}-segments"):
+            return download_book(book_id, scheduler, resource_cache, args.embed_resources_as_base64,
+                                 args.store, processes, args.chapters, args.priority)
+
+    try:
+        with processes:
+            results = scheduler.run(book_ids, download)
+    finally:
+        metrics.close()
+        if not args.fixed_rate:
+            save_rate_limiter(rate_limiter, cookies)
+
+    if not log_summary(results, unit="segments"):
+        sys.exit(1)
+
+
+def decode_html_entities(text):
+    return re.sub(r"&#(\d+);", lambda match: chr(int(match.group(1))), text)
+
+
+def download_resource(scheduler, url):
+    with scheduler.rate_limiter.request():  # Within the same limit as the segments
+        response = fetch(scheduler.session, url)
+        scheduler.rate_limiter.observe(response)
+    return response.headers.get("content-type", "application/octet-stream"), response.content
+
+
+def resource_filename(content_type, buffer):
+    """Name of the resource in resources/, the same for all the resources with the same content."""
+    ext = mimetypes.guess_extension(content_type.split(";")[0].strip()) or ""
+    return f"{hashlib.sha256(buffer).hexdigest()[:16]}{ext}"
+
+
+def embed_resource(element, data_url):
+    tag_name = element.name.lower()
+    if tag_name == "style":
+        element.string = f"@import url({data_url});"
+    elif tag_name == "img":
+        element["src"] = data_url
+        element.attrs.pop("width", None)
+        element.attrs.pop("height", None)
+    elif tag_name == "link":
+        element["href"] = data_url
+    elif tag_name == "object":
+        element["data"] = data_url
+    else:
+        element["src"] = data_url
+
+
+def select_resource_elements(html_string):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html_string, "html.parser")
+    resource_elements = soup.select(
+        'img[src^="http"], link[rel="stylesheet"][href^="http"], script[src^="http"], audio[src^="http"], video[src^="http"], source[src^="http"], object[data^="http"], embed[src^="http"], iframe[src^="http"], *[style*="url(http"]'
+    )
+    return soup, [(element, element.get("src") or element.get("href") or element.get("data"))
+                  for element in resource_elements]
+
+
+def find_resources(html_string):
+    """Return the URLs of the resources referenced in html_string."""
+    _soup, resource_elements = select_resource_elements(html_string)
+    return [url for _element, url in resource_elements]
+
+
+def embed_resources(html_string, resource_url):
+    """Replace the URL of each resource referenced in html_string by resource_url(url)."""
+    soup, resource_elements = select_resource_elements(html_string)
+
+    for element, url in resource_elements:
+        embed_resource(element, resource_url(url))
+
+    return str(soup)
+
+
+def decrypt(buf, aes_key):
+    from Cryptodome.Cipher import AES
+
+    iv = buf[:16]
+    str_expected_length = int.from_bytes(buf[16:20], "little")
+    data = buf[20:]
+
+    cipher = AES.new(aes_key, AES.MODE_CBC, iv)
+    decrypted_page_data = cipher.decrypt(data)
+
+    return decrypted_page_data[:str_expected_length].decode("utf-8")
+
+
+def fetch_segment(session, url):
+    segment_url = urlparse(url)
+    query = parse_qs(segment_url.query)
+    query["enc_all"] = ["1"]
+    # Fix encoding issues with Cyrillic
+    query["hl"] = ["en"]
+    segment_url = segment_url._replace(query=urlencode(query, doseq=True))
+    full_url = urlunparse(segment_url)
+
+    response = fetch(session, full_url)
+    return response
+
+
+def decode_segment(encoded_segment, aes_key):
+    """Decrypt a segment and find its resources. Runs in the process pool of the book, as it's CPU-bound."""
+    decrypt_start = time.perf_counter()
+    response = decrypt(base64.b64decode(encoded_segment), aes_key)
+    decrypt_seconds = time.perf_counter() - decrypt_start
+
+    segment_obj = json.loads(response)
+    html = segment_obj["content"]
+    return response, html, segment_obj["style"], find_resources(html), decrypt_seconds
+
+
+def process_segment(book_id, segment, aes_key, scheduler, processes, resource_cache, embed_as_base64):
+    """Download a segment, decrypt it and rewrite the URLs of its resources. Runs on the workers of the scheduler."""
+    session = scheduler.session
+    segment_url = PLAY_BOOKS_BASE_URL + segment["link"]
+    start_time = time.perf_counter()
+    stats = {}
+
+    logging.info(f"[{book_id}] ===> segment #{segment['order']}: {segment['label']} ({segment['title']})")
+    with scheduler.rate_limiter.request():  # Be gentle with Google Play Books
+        segment_response = fetch_segment(session, segment_url)
+        scheduler.rate_limiter.observe(segment_response)
+    if segment_response.text.lstrip().startswith("<"):  # The segments are base64, it's an HTML page instead
+        raise CredentialsExpired(f"got an HTML page instead of the segment {segment['label']}, probably the login page")
+    stats["latency_seconds"] = segment_response.elapsed.total_seconds()
+    stats["bytes"] = len(segment_response.content)
+    stats["retries"] = len(segment_response.raw.retries.history) if segment_response.raw.retries else 0
+
+    response, html, css, resource_urls, stats["decrypt_seconds"] = processes.submit(
+        decode_segment, segment_response.text, aes_key).result()
+
+    rewrite_start = time.perf_counter()
+    replacements = {}
+    resources = {}  # Files to save in resources/: filename -> (content type, content)
+    for url in dict.fromkeys(resource_urls):
+        content_type, buffer = resource_cache.get(url, lambda u: download_resource(scheduler, u))
+        if embed_as_base64:
+            replacements[url] = f"data:{content_type};base64,{base64.b64encode(buffer).decode('utf-8')}"
+        else:
+            filename = resource_filename(content_type, buffer)
+            resources[filename] = (content_type, buffer)
+            replacements[url] = f"resources/{filename}"
+    fixed_html = processes.submit(embed_resources, html, replacements.get).result() if replacements else html
+    # Includes downloading the resources when they aren't cached yet
+    stats["rewrite_seconds"] = time.perf_counter() - rewrite_start
+
+    return {
+        "url": segment_url,
+        "status": segment_response.status_code,
+        "response": response,
+        # The HTML of the segment keeps the URLs of the resources when they are embedded in the "old stuff" HTML only
+        "xhtml": html if embed_as_base64 else fixed_html,
+        "css": css,
+        "fixed_html": fixed_html,
+        "resources": resources,
+        "start_time": start_time,
+        "stats": stats,
+    }
+
+
+def save_segment(store, segment, result, saved_resources, embed_as_base64):
+    """Write the files of a processed segment and return the name of its "old stuff" files."""
+    label = segment["label"]
+    write_start = time.perf_counter()
+
+    for filename, (content_type, buffer) in result["resources"].items():
+        if filename not in saved_resources:
+            with store.open(f"resources/{filename}", "wb") as f:
+                f.write(buffer)
+            saved_resources[filename] = content_type
+
+    with store.open(f"segments/{label}.json", "w") as f:
+        json.dump(result["response"], f, indent=4)
+
+    css = result["css"]
+
+    # FIXME: what if label is not actually unique?
+    with store.open(f"{label}.xhtml", "w") as f:
+        f.write(result["xhtml"])
+    with store.open(f"{label}.css", "w") as f:
+        f.write(css)
+
+    # Old stuff
+
+    filename = decode_html_entities(f"{segment['order']} - {segment['title']}.json")
+    with store.open(f"segments/{filename}", "w") as f:
+        json.dump(segment, f, indent=4)
+
+    fixed_html = result["fixed_html"]
+    if embed_as_base64:
+        base_tag = ""
+    else:
+        # The resource paths are relative to the book folder, which is the parent of segments/
+        base_tag = '\n  <base href="../">'
+    with store.open(f"segments/{filename}.css", "w") as f:
+        f.write(css)
+    with store.open(f"segments/{filename}.html", "w") as f:
+        f.write(f"""<!DOCTYPE html>
+<html>
+<head>
+  <meta charset="utf-8">
+  <meta http-equiv="Content-Type" content="text/html; charset=utf-8">{base_tag}
+  <link rel="stylesheet" href="{'segments/' if base_tag else ''}{filename}.css">
+</head>
+<body>
+  {fixed_html}
+</body>
+</html>""")
+
+    result["stats"]["write_seconds"] = time.perf_counter() - write_start
+
+    return filename
+
+
+def download_book(book_id, scheduler, resource_cache=None, embed_as_base64=EMBED_RESOURCES_AS_BASE64,
+                  store_backend=None, processes=None, chapters=None, priority=False):
+    """Download the segments of a book in books/[book_id]. Its AES key and manifest must already be there."""
+    if processes is None:
+        with ProcessPoolExecutor() as processes:
+            return download_book(book_id, scheduler, resource_cache, embed_as_base64, store_backend, processes,
+                                 chapters, priority)
+
+    store = open_book_store(f"books/{book_id}", store_backend)
+    try:
+        return download_book_to_store(book_id, store, scheduler, resource_cache, embed_as_base64, processes,
+                                      chapters, priority)
+    finally:
+        store.close()
+
+
+def select_segments(book_id, manifest, chapters):
+    """Return the indexes in the manifest of the segments selected by their order or their title."""
+    selected = [n for n, segment in enumerate(manifest["segment"])
+                if is_selected(int(segment["order"]), decode_html_entities(segment["title"]), chapters)]
+    log_selection(book_id, selected, len(manifest["segment"]), "segments")
+    return selected
+
+
+def download_book_to_store(book_id, store, scheduler, resource_cache, embed_as_base64, processes, chapters=None,
+                           priority=False):
+    book_dir = store.book_dir
+    resource_cache = resource_cache or ResourceCache(f"{book_dir}/resource-cache", RESOURCE_CACHE_MAX_BYTES)
+
+    # Filename in resources/ -> content type. Starts from the resources of the previous runs, which may have downloaded
+    # other segments with --chapters.
+    try:
+        with store.open("resources.json", "r") as f:
+            saved_resources = json.load(f)
+    except FileNotFoundError:
+        saved_resources = {}
+
+    with store.open("aes_key.bin", "rb") as f:
+        aes_key = f.read()
+
+    with store.open("manifest.json", "r") as f:
+        manifest = json.load(f)
+
+    total = len(manifest["segment"])
+    segment_files = []
+
+    with store.open("segments.txt", "w") as segments_file:
+        segments_file.writelines(
+            list(map(lambda s: s["label"] + "\n", manifest["segment"])))
+
+    queue, priority_count = list(range(total)), 0
+    if chapters is not None:
+        selected = select_segments(book_id, manifest, chapters)
+        if priority:
+            queue, priority_count = priority_order(selected, total)
+        else:
+            queue = selected
+    segments = [manifest["segment"][n] for n in queue]
+
+    logging.info(f"[{book_id}] Starting to download {len(segments)} segments…")
+
+    submit_time = time.perf_counter()
+    futures = [scheduler.submit_page(process_segment, book_id, segment, aes_key, scheduler, processes,
+                                     resource_cache, embed_as_base64) for segment in segments]
+
+    # The segments are written in the order they were queued whichever finishes first (the order of the manifest,
+    # unless --priority is used), so that the files and the resources they reference are the same from one run to
+    # the next
+    for position, (segment, future) in enumerate(zip(segments, futures)):
+        if position == priority_count and priority_count:
+            logging.info(f"[{book_id}] The selected segments are done, downloading the rest of the book…")
+        try:
+            result = future.result()
+            filename = save_segment(store, segment, result, saved_resources, embed_as_base64)
+
+            segment_files.append(filename)
+            logging.info(f"[{book_id}] Saved to {filename} (url: {result['url']})")
+            scheduler.metrics.record("segment", result["status"], book_id=book_id, label=segment["label"],
+                                     total_seconds=time.perf_counter() - result["start_time"], **result["stats"])
+        except Exception as e:
+            segment_url = PLAY_BOOKS_BASE_URL + segment["link"]
+            logging.error(f"[{book_id}] Error! Download or decrypt failed (url: {segment_url}) failed with {e}")
+            status = getattr(getattr(e, "response", None), "status_code", None) or type(e).__name__
+            scheduler.metrics.record("segment", status, book_id=book_id, label=segment["label"],
+                                     total_seconds=time.perf_counter() - submit_time)
+
+    resource_cache.save()  # Persist the last use of the cached resources for the eviction
+
+    if saved_resources:
+        # Used by play_book_epub_tool.py to add the resources to the EPUB
+        with store.open("resources.json", "w") as f:
+            json.dump(saved_resources, f, indent=4)
+
+    logging.info(
+        f'[{book_id}] Finished. The segments that got successfully downloaded can be found in "{book_dir}/segments".')
+
+    return {"downloaded": len(segment_files), "total": len(segments)}
@@ -0,0 +1,73 @@
+import json
+import logging
+import os
+import threading
+
+from play_book_downloader.resolution import MAX_RENDERING
+
+JOURNAL_FILENAME = "journal.jsonl"
+
+
+class PageJournal:
+    """Append-only record of the pages that were completely downloaded, used to resume an interrupted download."""
+
+    def __init__(self, store):
+        self.store = store
+        self.path = os.path.join(store.book_dir, JOURNAL_FILENAME)
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.needs_newline = False  # The last line of the file isn't terminated
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as journal_file:
+                for line in journal_file:
+                    self.needs_newline = not line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                        if entry.get("removed"):
+                            self.entries.pop(entry["pid"], None)
+                        else:
+                            self.entries[entry["pid"]] = entry
+                    except (ValueError, KeyError):
+                        # The last line can be incomplete if the previous run was killed while writing it
+                        logging.warning(f"Ignoring invalid line in {self.path}: {line.strip()}")
+        except FileNotFoundError:
+            pass
+
+    def record(self, pid, filename, size, sha256, rendering=MAX_RENDERING):
+        entry = {"pid": pid, "file": filename, "size": size, "sha256": sha256, "rendering": rendering}
+        with self.lock:
+            self.entries[pid] = entry
+            self.append(entry)
+
+    def forget(self, pid):
+        """Drop the page from the journal, e.g. because its file is corrupted, so that it isn't listed in pages.txt."""
+        with self.lock:
+            if self.entries.pop(pid, None) is not None:
+                self.append({"pid": pid, "removed": True})
+
+    def append(self, entry):
+        with open(self.path, "a", encoding="utf-8") as journal_file:
+            # Start on a new line after an incomplete one, instead of making this entry invalid too
+            journal_file.write(("\n" if self.needs_newline else "") + json.dumps(entry) + "\n")
+        self.needs_newline = False
+
+    def verified_file(self, pid, rendering=MAX_RENDERING):
+        """Return the file of the page if it was recorded with this rendering and is still intact, None otherwise."""
+        entry = self.entries.get(pid)
+        if not entry:
+            return None
+
+        try:
+            intact = (self.store.size(entry["file"]) == entry["size"]
+                      and self.store.sha256(entry["file"]) == entry["sha256"])
+        except OSError:
+            intact = False
+        if not intact:
+            logging.warning(f"The file of {pid} in the journal is missing or corrupted, downloading it again")
+            self.forget(pid)
+            return None
+
+        if entry.get("rendering", MAX_RENDERING) != rendering:
+            return None
+        return entry["file"]
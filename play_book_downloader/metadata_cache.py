@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+import time
+
+from play_book_downloader.session import fetch_streamed
+
+METADATA_CACHE_FILENAME = "metadata_cache.json"
+# The page links of the manifest are signed by Google and eventually expire, so the metadata is revalidated with the
+# server once it's older than this. Revalidation is cheap when the server supports ETag or If-Modified-Since.
+METADATA_CACHE_TTL = 3600
+NOT_MODIFIED = object()
+
+
+class MetadataCache:
+    """Remembers when the metadata of a book (reader page, manifest) was fetched, to skip fetching it again."""
+
+    def __init__(self, store, ttl=METADATA_CACHE_TTL):
+        self.book_store = store
+        self.ttl = ttl
+        self.path = os.path.join(store.book_dir, METADATA_CACHE_FILENAME)
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as cache_file:
+                self.entries = json.load(cache_file)
+        except FileNotFoundError:
+            self.entries = {}
+        except ValueError:
+            logging.warning(f"The metadata cache {self.path} is corrupted, fetching the metadata again")
+            self.entries = {}
+
+    def fetch(self, name, session, url, consume=None):
+        """Return the response of url, or None if the files produced by the previous response can be used instead."""
+        consume = consume or load_body
+        entry = self.entries.get(name)
+        if not entry or not self.files_intact(entry):
+            return fetch_streamed(session, url, consume)
+
+        if time.time() - entry["fetched_at"] < self.ttl:
+            return None
+
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        if not headers:
+            return fetch_streamed(session, url, consume)
+
+        result = fetch_streamed(
+            session, url, lambda response: NOT_MODIFIED if response.status_code == 304 else consume(response),
+            headers=headers)
+        if result is not NOT_MODIFIED:
+            return result
+
+        entry["fetched_at"] = time.time()
+        self.save()
+        return None
+
+    def store(self, name, response, files, **fields):
+        """Record the response once the files (names in the book store) produced from it are written."""
+        self.entries[name] = {
+            "fetched_at": time.time(),
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "files": {filename: self.book_store.size(filename) for filename in files},
+            **fields,
+        }
+        self.save()
+
+    def get(self, name, field, default=None):
+        return self.entries.get(name, {}).get(field, default)
+
+    def files_intact(self, entry):
+        for filename, size in entry["files"].items():
+            try:
+                if self.book_store.size(filename) != size:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def save(self):
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as cache_file:
+            json.dump(self.entries, cache_file, indent=4)
+        os.replace(temporary_path, self.path)
+
+
+def load_body(response):
+    response.content  # Read the whole body, like fetch()
+    return response
@@ -0,0 +1,115 @@
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+PROFILE_DIR = "profiles"
+
+
+class MetricsRecorder:
+    """Records structured metrics (one JSON object per line) and writes a Prometheus text-format summary on close()."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.counts = {}  # (stage, status) -> number of records
+        self.values = {}  # (stage, field) -> values
+        self.file = open(path, "w", encoding="utf-8") if path else None
+
+    def record(self, stage, status="ok", **fields):
+        if not self.file:
+            return
+
+        with self.lock:
+            self.file.write(json.dumps({"time": time.time(), "stage": stage, "status": status, **fields}) + "\n")
+
+            self.counts[(stage, str(status))] = self.counts.get((stage, str(status)), 0) + 1
+            for field, value in fields.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self.values.setdefault((stage, field), []).append(value)
+
+    def close(self):
+        if not self.file:
+            return
+
+        with self.lock:
+            self.file.close()
+            with open(f"{os.path.splitext(self.path)[0]}.prom", "w", encoding="utf-8") as prom_file:
+                prom_file.write(self.prometheus_summary())
+
+    def prometheus_summary(self):
+        lines = [
+            "# HELP play_books_items_total Number of items processed, by stage and status.",
+            "# TYPE play_books_items_total counter",
+        ]
+        for (stage, status), count in sorted(self.counts.items()):
+            lines.append(f'play_books_items_total{{stage="{stage}",status="{status}"}} {count}')
+
+        for field in sorted({field for _stage, field in self.values}):
+            name = f"play_books_{field}"
+            lines.append(f"# TYPE {name} summary")
+            for (stage, values_field), values in sorted(self.values.items()):
+                if values_field != field:
+                    continue
+                sorted_values = sorted(values)
+                for q in (0.5, 0.9, 0.99):
+                    lines.append(f'{name}{{stage="{stage}",quantile="{q}"}} {quantile(sorted_values, q)}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {sum(values)}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {len(values)}')
+
+        return "\n".join(lines) + "\n"
+
+
+def quantile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class StageProfiler:
+    """Times the stages of a run and, when enabled (--profile), profiles them with cProfile and tracemalloc."""
+
+    def __init__(self, directory=None, metrics=None):
+        self.directory = directory
+        self.metrics = metrics or MetricsRecorder()
+        self.lock = threading.Lock()
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def stage(self, name):
+        start_time = time.perf_counter()
+
+        if not self.directory or not self.lock.acquire(blocking=False):
+            try:
+                yield
+            finally:
+                self.metrics.record("stage", name=name, seconds=time.perf_counter() - start_time)
+            return
+
+        try:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            profiler = cProfile.Profile()
+
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+
+                seconds = time.perf_counter() - start_time
+                _current, peak = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot()
+
+                profiler.dump_stats(os.path.join(self.directory, f"{name}.prof"))
+                with open(os.path.join(self.directory, f"{name}.tracemalloc.txt"), "w", encoding="utf-8") as f:
+                    f.write(f"Peak traced memory: {peak} bytes\n\n")
+                    f.writelines(f"{stat}\n" for stat in snapshot.statistics("lineno")[:50])
+
+                self.metrics.record("stage", name=name, seconds=seconds, peak_traced_bytes=peak)
+        finally:
+            self.lock.release()
@@ -0,0 +1,712 @@
+import sys
+import json
+import re
+import base64
+import hashlib
+import logging
+import argparse
+import time
+
+from concurrent.futures import as_completed
+from urllib.parse import urlparse, urlencode, urlunparse, parse_qs
+
+from play_book_downloader.adaptive import load_rate_limiter, save_rate_limiter
+from play_book_downloader.batch import BatchScheduler, log_summary
+from play_book_downloader.book_store import open_book_store, BOOK_STORES
+from play_book_downloader.credentials import CredentialManager, CredentialsExpired, CREDENTIALS_WAIT_TIMEOUT, CURL_PATH
+from play_book_downloader.journal import PageJournal
+from play_book_downloader.metadata_cache import MetadataCache, METADATA_CACHE_TTL
+from play_book_downloader.metrics import MetricsRecorder, StageProfiler, PROFILE_DIR
+from play_book_downloader.reader_page import scan_reader_page
+from play_book_downloader.resolution import choose_rendering, MAX_RENDERING
+from play_book_downloader.selection import is_selected, log_selection, parse_page_ranges, parse_selection, \
+    priority_order
+from play_book_downloader.session import create_session, fetch_streamed, RateLimiter, HTTP_POOL_SIZE, \
+    PLAY_BOOKS_BASE_URL
+
+GOOGLE_MAX_REQUESTS_PER_SECOND = 10  # Shared by all the workers, to reduce risk of getting flagged for abuse.
+# Maximum number of pages that are downloaded and decrypted at the same time. Unless --fixed-rate is used, the rate
+# limiter adapts the rate and the number of parallel requests to the responses of Google Play Books within these limits.
+GOOGLE_PAGE_DOWNLOAD_WORKERS = 8
+PARALLEL_BOOKS = 2  # Number of books downloaded at the same time in batch mode. They share the workers.
+PAGE_DOWNLOAD_CHUNK_SIZE = 256 * 1024  # Pages are decrypted and written while they download, one chunk at a time.
+PAGE_PROBE_CHUNK_SIZE = 4 * 1024  # The size of a page is read from its header, which is in its first bytes
+WEBP_HEADER_SIZE = 30
+
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Download the pages of one or several Google Play Books.")
+    parser.add_argument("book_ids", nargs="*", metavar="book_id",
+                        help="ID of the book, found in the URL of the book page. Asked interactively if omitted.")
+    parser.add_argument("--book-list", type=argparse.FileType("r", encoding="utf-8"),
+                        help="File with the IDs of the books to download, one per line.")
+    parser.add_argument("--parallel-books", type=int, default=PARALLEL_BOOKS,
+                        help=f"Number of books downloaded at the same time (default: {PARALLEL_BOOKS}).")
+    parser.add_argument("--workers", type=int, default=GOOGLE_PAGE_DOWNLOAD_WORKERS,
+                        help=f"Maximum number of pages downloaded in parallel, for all the books (default: {GOOGLE_PAGE_DOWNLOAD_WORKERS}).")
+    parser.add_argument("--max-rps", type=float, default=GOOGLE_MAX_REQUESTS_PER_SECOND,
+                        help=f"Maximum number of page requests per second, for all the books (default: {GOOGLE_MAX_REQUESTS_PER_SECOND}).")
+    parser.add_argument("--fixed-rate", action="store_true",
+                        help="Always send --max-rps requests per second with --workers in parallel, instead of adapting "
+                             "the rate to the responses of Google Play Books.")
+    parser.add_argument("--pool-size", type=int, default=HTTP_POOL_SIZE,
+                        help=f"Number of HTTP connections kept open to Google Play Books (default: {HTTP_POOL_SIZE}).")
+    parser.add_argument("--credentials-timeout", type=float, default=CREDENTIALS_WAIT_TIMEOUT, metavar="SECONDS",
+                        help="When the cookies expire during the download, pause it and wait this long for a new cURL "
+                             f"command in {CURL_PATH} before giving up, 0 to fail right away (default: "
+                             f"{CREDENTIALS_WAIT_TIMEOUT}).")
+    parser.add_argument("--metadata-ttl", type=float, default=METADATA_CACHE_TTL, metavar="SECONDS",
+                        help="Reuse the AES key and the manifest of the previous run while they are younger than this, "
+                             f"and revalidate them with the server after that (default: {METADATA_CACHE_TTL}).")
+    parser.add_argument("--target-width", type=int, metavar="PIXELS",
+                        help="Download the pages at the smallest resolution that is at least this wide, instead of the "
+                             "highest one (e.g. the screen width of your e-reader).")
+    parser.add_argument("--target-height", type=int, metavar="PIXELS",
+                        help="Download the pages at the smallest resolution that is at least this high.")
+    parser.add_argument("--target-dpi", type=float,
+                        help="Download the pages at the smallest resolution that has at least this DPI once printed at "
+                             "the size of the book.")
+    parser.add_argument("--preview", action="store_true",
+                        help="Quickly download low resolution thumbnails of the pages, e.g. to check a book. They are "
+                             "downloaded again at full resolution by the next run without --preview.")
+    parser.add_argument("--pages", type=parse_page_ranges, metavar="RANGES",
+                        help="Only download these pages, e.g. 1-20,45,100- (numbered from 1 in the order of the book).")
+    parser.add_argument("--chapters", type=parse_selection, metavar="CHAPTERS",
+                        help="Only download the pages of these chapters of toc.txt, given by number (e.g. 3-5, "
+                             "numbered from 1 including the sub-chapters) or by a part of their title (e.g. "
+                             "\"Introduction,Appendix\"). A chapter includes its sub-chapters.")
+    parser.add_argument("--priority", action="store_true",
+                        help="Download the cover and the pages selected by --pages and --chapters first, and then the "
+                             "rest of the book.")
+    parser.add_argument("--store", choices=BOOK_STORES,
+                        help="Save the pages and the metadata of each book as files in its folder, or all together in "
+                             "a single book.sqlite file (faster on network storage). Defaults to the store the book "
+                             "already has, or files.")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="Write metrics for each page to FILE (JSON lines) and a Prometheus summary next to it.")
+    parser.add_argument("--profile", action="store_true",
+                        help=f"Profile each stage with cProfile and tracemalloc, the results are saved in {PROFILE_DIR}/.")
+    args = parser.parse_args(argv)
+
+    book_ids = list(args.book_ids)
+    if args.book_list:
+        book_ids += read_book_list(args.book_list)
+    if not book_ids:
+        book_ids = [input("Type your book ID and press enter: ")]
+
+    logging.basicConfig(level=logging.INFO,
+                        format="[%(asctime)s] %(levelname)s: %(message)s")
+
+    cookies, headers = read_curl_credentials()
+
+    logging.info(f"Script started for book ids: {', '.join(book_ids)}")
+
+    session = create_session(cookies, headers, pool_size=args.pool_size)
+    metrics = MetricsRecorder(args.metrics)
+    profiler = StageProfiler(PROFILE_DIR if args.profile else None, metrics)
+    rate_limiter = create_rate_limiter(cookies, args.max_rps, args.workers, args.fixed_rate)
+    credentials = create_credential_manager(session, args.credentials_timeout)
+    scheduler = BatchScheduler(session, rate_limiter, args.workers, args.parallel_books, metrics, profiler,
+                               credentials)
+
+    resolution_target = {"target_width": args.target_width, "target_height": args.target_height,
+                         "target_dpi": args.target_dpi, "preview": args.preview}
+
+    def download(book_id, scheduler):
+        return download_book(book_id, scheduler, args.metadata_ttl, resolution_target=resolution_target,
+                             store_backend=args.store, pages=args.pages, chapters=args.chapters,
+                             priority=args.priority)
+
+    try:
+        results = scheduler.run(book_ids, download)
+    finally:
+        metrics.close()
+        if not args.fixed_rate:
+            save_rate_limiter(rate_limiter, cookies)
+
+    if not log_summary(results):
+        sys.exit(1)
+
+
+def create_rate_limiter(cookies, max_rps, workers, fixed_rate=False):
+    """Return a RateLimiter with a fixed rate, or an adaptive one that starts from the rate learned for the account."""
+    if fixed_rate:
+        return RateLimiter(max_rps)
+    return load_rate_limiter(cookies, max_rps, workers)
+
+
+def create_credential_manager(session, timeout=CREDENTIALS_WAIT_TIMEOUT):
+    """Return the CredentialManager that reloads curl.txt into the session when it expires, or None if timeout is 0."""
+    if timeout <= 0:
+        return None
+    return CredentialManager(session, read_curl_credentials, CURL_PATH, timeout)
+
+
+def read_book_list(book_list_file):
+    """Read one book ID per line, ignoring empty lines and comments starting with #."""
+    book_ids = []
+    for line in book_list_file:
+        book_id = line.split("#", 1)[0].strip()
+        if book_id:
+            book_ids.append(book_id)
+    return book_ids
+
+
+def read_curl_credentials(curl_path=CURL_PATH):
+    try:
+        with open(curl_path, "r") as f:
+            curl_command = f.read().strip()
+    except FileNotFoundError:
+        print("""\nYou will need to provide your cookies in order to download books. Here is how:
+1) Go to https://play.google.com/books and log in.
+2) Open dev console, network tab.
+3) Click on the book you want to read (the link should have the format https://play.google.com/books/reader?id=xxxxxxxxxx)
+4) In the network tab of the dev console type "segment" (without the quotes) in the filter box.
+5) Right-click on the first request (it should appear as segment?authuser=0&xxxxxxxxx) in the dev console and then click on "Copy as cURL", or "Copy as cURL (bash)", or "Copy as cURL (POSIX)" whichever appears (the name of this option depends on your browser and OS).
+6) Create the file curl.txt and paste it inside\n""")
+        raise FileNotFoundError("curl.txt file not found. Please create it and put the curl command from the browser.")
+    except IOError as e:
+        raise IOError(f"Error reading curl.txt: {e}")
+
+    try:
+        url, cookies, headers = parse_curl_command(curl_command)
+    except ValueError as e:
+        raise ValueError(f"Failed to parse curl command: {e}")
+
+    expected_netloc = urlparse(PLAY_BOOKS_BASE_URL).netloc
+    if url.netloc != expected_netloc:
+        raise ValueError(f"Invalid curl command in curl.txt. The domain name should be to '{expected_netloc}' but in the command it is: {url.netloc}")
+
+    return cookies, headers
+
+
+def download_book(book_id, scheduler, metadata_ttl=METADATA_CACHE_TTL, on_page=None, resolution_target=None,
+                  store_backend=None, rendering=None, refetch=(), pages=None, chapters=None, priority=False):
+    """Download the metadata and the pages of a book in books/[book_id]. The pages are queued on the scheduler."""
+    store = open_book_store(f"books/{book_id}", store_backend)
+    try:
+        return download_book_to_store(book_id, store, scheduler, metadata_ttl, on_page, resolution_target, rendering,
+                                      refetch, pages, chapters, priority)
+    finally:
+        store.close()
+
+
+def download_book_to_store(book_id, store, scheduler, metadata_ttl, on_page, resolution_target, rendering, refetch,
+                           pages=None, chapters=None, priority=False):
+    session = scheduler.session
+
+    with scheduler.profiler.stage(f"{book_id}-metadata"):
+        credentials = scheduler.credentials
+        generation = credentials and credentials.generation
+        aes_key, manifest = scheduler.call(download_metadata, book_id, store, session, metadata_ttl)
+        # A book in preview mode usually isn't in the library of the account, so this doesn't wait for new credentials.
+        # But if curl.txt got new ones in the meantime, the metadata is downloaded again with them.
+        if (credentials and manifest.get("metadata", {}).get("preview") != "full"
+                and credentials.has_new_credentials(generation)):
+            # Not from the metadata cache, which has the ones of the expired credentials
+            aes_key, manifest = scheduler.call(download_metadata, book_id, store, session, 0)
+        if rendering is None:
+            rendering = choose_rendering(
+                book_id, manifest, lambda: probe_page_size(book_id, store, manifest, aes_key, scheduler),
+                **(resolution_target or {}))
+
+    missing_pages = [p["pid"] for p in manifest["page"] if
+                     not p.get("src") or not isinstance(p["src"], str)]
+    missing = len(missing_pages)
+    total = len(manifest["page"])
+
+    if missing != 0:
+        missing_percent = f"{(missing / total):.2%}"
+        logging.error(
+            f"[{book_id}] Error! Couldn't find a download link for {missing} pages ({missing_percent} missing, total: {total} pages).List of missing pages: [{', '.join(map(str, missing_pages))}]"
+        )
+
+    queue, priority_count = None, 0
+    if pages is not None or chapters is not None:
+        selected = select_pages(book_id, store, manifest, pages, chapters)
+        if priority:
+            queue, priority_count = priority_order(selected, total, first=[0])
+        else:
+            queue = selected
+
+    logging.info(f"[{book_id}] Starting to download {total if queue is None else len(queue)} pages…")
+
+    with scheduler.profiler.stage(f"{book_id}-pages"):
+        page_files = download_pages(book_id, store, manifest, aes_key, scheduler, on_page, rendering, refetch, queue,
+                                    priority_count)
+
+    logging.info(
+        f'[{book_id}] Finished. The pages that got successfully downloaded can be found in "{store.book_dir}".')
+
+    return {"downloaded": len(page_files), "total": total if queue is None else len(queue)}
+
+
+def select_pages(book_id, store, manifest, pages=None, chapters=None):
+    """Return the indexes in the manifest of the pages selected by page ranges and/or chapters, in the book order."""
+    total = len(manifest["page"])
+    selected = set()
+
+    for first, last in pages or []:
+        selected.update(range(first - 1, min(last if last is not None else total, total)))
+
+    if chapters is not None:
+        try:
+            with store.open("toc.json", "r") as toc_file:
+                toc = json.load(toc_file)
+        except FileNotFoundError:
+            logging.error(f"[{book_id}] Error! There is no table of contents to select the chapters from")
+            toc = []
+        for n, entry in enumerate(toc):
+            if is_selected(n + 1, unescape_html(entry["label"]), chapters):
+                end = next((e["page_index"] for e in toc[n + 1:] if e["depth"] <= entry["depth"]), total)
+                selected.update(range(entry["page_index"], min(max(end, entry["page_index"] + 1), total)))
+
+    log_selection(book_id, selected, total, "pages")
+    return sorted(selected)
+
+
+def download_metadata(book_id, store, session, metadata_ttl=METADATA_CACHE_TTL):
+    """Download the AES key, the manifest and the table of contents of the book. Returns the key and the manifest."""
+    cache = MetadataCache(store, metadata_ttl)
+
+    # &hl=en is necessary to fix encoding issues with Cyrillic. The page is only read until the key and the TOC are
+    # found, then the connection is closed.
+    reader = cache.fetch("reader", session, f"{PLAY_BOOKS_BASE_URL}/books/reader?id={book_id}&hl=en",
+                         lambda response: (response, scan_reader_page(response)))
+    if reader is None:
+        with store.open("aes_key.bin", "rb") as key_file:
+            aes_key = key_file.read()
+        toc = None
+        if cache.get("reader", "has_toc"):
+            with store.open("toc.json", "r") as toc_file:
+                toc = json.load(toc_file)
+        logging.info(f"[{book_id}] Using the cached AES decryption key: [{aes_key.hex()}]")
+    else:
+        response, (key_data, toc_data) = reader
+
+        aes_key = extract_decryption_key(key_data)
+        with store.open("aes_key.bin", "wb") as key_file:
+            key_file.write(aes_key)
+        logging.info(f"[{book_id}] Found AES decryption key: [{aes_key.hex()}]")
+
+        toc = extract_toc(toc_data)
+        if toc:
+            with store.open("toc.json", "w") as toc_file:
+                json.dump(toc, toc_file, indent=4)
+        cache.store("reader", response, ["aes_key.bin", *(["toc.json"] if toc else [])], has_toc=bool(toc))
+
+    manifest_response = cache.fetch(
+        "manifest", session, f"{PLAY_BOOKS_BASE_URL}/books/volumes/{book_id}/manifest?hl=en&authuser=2&source=ge-web-app")
+    if manifest_response is None:
+        with store.open("manifest.json", "r") as manifest_file:
+            manifest = json.load(manifest_file)
+        logging.info(f"[{book_id}] Using the cached manifest")
+    else:
+        manifest_text = manifest_response.text
+        manifest = json.loads(manifest_text)
+        with store.open("manifest.json", "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=4)
+        cache.store("manifest", manifest_response, ["manifest.json"])
+
+    if manifest.get("metadata", {}).get("preview") != "full":
+        logging.error(f"[{book_id}] The server indicates that the book is in preview mode '{manifest.get('preview')}' (expected 'full'). This either means that you don't own the book on this account, or that your curl command is invalid/expired. Delete curl.txt and follow the instructions again!")
+
+    if not toc:
+        toc = manifest.get("toc_entry")
+        if toc:
+            logging.warning(
+                f"[{book_id}] Using the table of contents from the manifest as a fallback. Note that it's inferior because everything is flattened to the top level instead of having subchapters"
+            )
+        else:
+            logging.error(f"[{book_id}] Error! Couldn't find the table of contents in the book manifest")
+
+    if toc:
+        with store.open("toc.json", "w") as toc_file:
+            json.dump(toc, toc_file, indent=4)
+        logging.info(f"[{book_id}] Extracted the table of contents to toc.json")
+
+        try:
+            human_toc = "\n".join(
+                f"{'    ' * t['depth']}{unescape_html(t['label'])} ........".ljust(80,
+                                                                                   ".") + f" p.{t['page_index'] + 1}"
+                for t in toc
+            )
+            with store.open("toc.txt", "w") as human_toc_file:
+                human_toc_file.write(human_toc)
+            logging.info(f"[{book_id}] Wrote human-readable table of contents to toc.txt")
+        except Exception as e:
+            logging.warning(
+                f"[{book_id}] Warning: Couldn't produce a human-readable table of contents:\n{e}")
+
+    return aes_key, manifest
+
+
+def probe_page_size(book_id, store, manifest, aes_key, scheduler):
+    """Return the (width, height) of a page of the book at MAX_RENDERING, or None if there is no page to probe."""
+    from PIL import Image
+
+    pages = [page for page in manifest["page"] if page.get("src")]
+    if not pages:
+        return None
+    page = pages[len(pages) // 2]
+
+    if filename := PageJournal(store).verified_file(page["pid"]):
+        with store.open(filename, "rb") as page_file, Image.open(page_file) as image:
+            return image.size
+
+    def read_size(response):
+        scheduler.rate_limiter.observe(response)
+        if (response.headers.get("content-type") or "").startswith("text/html"):
+            raise CredentialsExpired(f"got an HTML page instead of the image of {page['pid']}, probably the login page")
+        # Only the start of the page is downloaded, the connection is closed once its header is read
+        return read_image_size(response.iter_content(PAGE_PROBE_CHUNK_SIZE), aes_key)
+
+    def fetch_size():
+        with scheduler.rate_limiter.request():
+            return fetch_streamed(scheduler.session, page_download_url(page["src"]), read_size)
+
+    logging.info(f"[{book_id}] Probing the native resolution of the pages with {page['pid']}…")
+    return scheduler.call(fetch_size)
+
+
+def download_pages(book_id, store, manifest, aes_key, scheduler, on_page=None, rendering=MAX_RENDERING, refetch=(),
+                   queue=None, priority_count=0):
+    """Queue the pages that aren't downloaded yet on the scheduler, and write pages.txt once they are done."""
+    total = len(manifest["page"])
+    journal = PageJournal(store)
+    on_page = on_page or (lambda manifest, index, filename: None)
+    queue = range(total) if queue is None else queue
+
+    futures = {}
+    priority_futures = set()
+    for position, i in enumerate(queue):
+        page = manifest["page"][i]
+        pid, src = page.get("pid"), page.get("src")
+        if pid in refetch:
+            journal.forget(pid)
+        elif filename := journal.verified_file(pid, rendering):
+            logging.info(f"[{book_id}] [{i + 1}/{total}] Skipped: {pid} was already downloaded by a previous run")
+            on_page(manifest, i, filename)
+            continue
+        if not src:
+            logging.error(f"[{book_id}] [{i + 1}/{total}] Skipped: download link for {pid} is missing…")
+            on_page(manifest, i, None)
+            continue
+
+        future = scheduler.submit_page(save_page, book_id, pid, src, aes_key, store, scheduler, journal, rendering)
+        futures[future] = i
+        if position < priority_count:
+            priority_futures.add(future)
+
+    for future in as_completed(futures):
+        p = f"{futures[future] + 1}/{total}"
+        try:
+            filename = future.result()
+            logging.info(f"[{book_id}] [{p}] Saved to {filename}")
+        except Exception as e:
+            logging.error(f"[{book_id}] [{p}] Error! Download or decrypt failed with {e}")
+            filename = None
+        on_page(manifest, futures[future], filename)
+
+        if future in priority_futures:
+            priority_futures.discard(future)
+            if not priority_futures:
+                logging.info(f"[{book_id}] The cover and the selected pages are done, downloading the rest of the book…")
+
+    # The journal includes the pages from the previous runs, and pages.txt has to follow the order of the manifest
+    page_files = [journal.entries[p["pid"]]["file"] for p in manifest["page"] if p.get("pid") in journal.entries]
+
+    with store.open("pages.txt", "w") as pages_file:
+        pages_file.write("\n".join(page_files))
+
+    return [journal.entries[pid]["file"] for pid in (manifest["page"][i].get("pid") for i in sorted(queue))
+            if pid in journal.entries]
+
+
+def save_page(book_id, pid, src, aes_key, store, scheduler, journal, rendering=MAX_RENDERING):
+    start_time = time.perf_counter()
+    stats = {}
+
+    def save_response(response):
+        scheduler.rate_limiter.observe(response)
+        stats["status"] = response.status_code
+        stats["latency_seconds"] = response.elapsed.total_seconds()
+        stats["retries"] = len(response.raw.retries.history) if response.raw.retries else 0
+
+        if (response.headers.get("content-type") or "").startswith("text/html"):
+            raise CredentialsExpired(f"got an HTML page instead of the image of {pid}, probably the login page")
+
+        ext = mime_to_ext(response.headers.get("content-type"))
+        filename = f"{pid}.{ext}"
+        # The store only makes the page visible under its final name once it's complete
+        with store.open(filename, "wb") as file:
+            size, sha256 = decrypt_stream(response.iter_content(PAGE_DOWNLOAD_CHUNK_SIZE), aes_key, file, stats)
+        return filename, size, sha256
+
+    try:
+        with scheduler.rate_limiter.request():  # Be gentle with Google Play Books
+            filename, size, sha256 = fetch_streamed(scheduler.session, page_download_url(src, rendering),
+                                                    save_response)
+    except Exception as e:
+        status = getattr(getattr(e, "response", None), "status_code", None) or type(e).__name__
+        scheduler.metrics.record("page", status, book_id=book_id, pid=pid,
+                                 total_seconds=time.perf_counter() - start_time)
+        raise
+
+    journal.record(pid, filename, size, sha256, rendering)
+    scheduler.metrics.record("page", stats.pop("status"), book_id=book_id, pid=pid,
+                             total_seconds=time.perf_counter() - start_time, **stats)
+
+    return filename
+
+
+def parse_curl_command(curl_command: str):
+    # Windows cmd.exe use ^ as an escape character, so browsers put them when copying a request as cURL which breaks our command parsing
+    # See: https://github.com/devnoname120/google-play-book-downloader/issues/28#issuecomment-3192839244
+    def is_likely_cmd_exe_command(cmd: str):
+        return re.search(r'\\^$', cmd, re.MULTILINE) or '^\\^"' in cmd or '^"^' in cmd
+
+    if is_likely_cmd_exe_command(curl_command):
+        logging.info(f"The command in curl.txt seems to be for Windows cmd.exe (normal if you copied it from your browser running on Windows)")
+        import mslex
+        def normalize_windows_cmd_caret(s: str) -> str:
+            s = s.replace("\r\n", "\n").strip()
+            s = re.sub(r"\s*\^\s*\n\s*", " ", s)
+            s = re.sub(r"\^(.)", r"\1", s)
+            return s
+        try:
+            [prog_name, *arg_list] = mslex.split(normalize_windows_cmd_caret(curl_command))
+        except ValueError:
+            logging.warning(f'Failed to parse curl.txt as a Windows command! Will try again assuming it\'s a command for Linux/macOS shells (NOT normal unless you used the option "Copy as cURL (bash)")')
+            import shlex
+            [prog_name, *arg_list] = shlex.split(curl_command.strip())
+    else:
+        logging.info(f'curl.txt seems to be for Linux/macOS shells (normal if copied on these OSs, or from Windows using the option "Copy as cURL (bash)")')
+        import shlex
+        [prog_name, *arg_list] = shlex.split(curl_command.strip())
+
+    if prog_name != "curl":
+        raise ValueError(f"Invalid curl command in curl.txt. The program name should be 'curl' but in the command it is: {prog_name}. Make sure you followed the instructions properly!")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url")
+    parser.add_argument("--header", "-H", action="append", dest="headers")
+    parser.add_argument("--cookie", "-b", action="append", dest="cookies")
+
+    args, _ = parser.parse_known_args(arg_list)
+
+    url = urlparse(args.url)
+
+    headers = {}
+    if not args.headers:
+        logging.warning(f"No headers detected in curl.txt! You likely didn't properly copy the cURL request to curl.txt")
+    else:
+        for header in args.headers:
+            key, value = header.split(":", 1)
+            headers[key.strip()] = value.strip()
+
+    cookies = {}
+    if not args.cookies:
+        logging.error(f"No cookies detected in curl.txt! You didn't properly copy the cURL request to curl.txt so the book will not be able to download correctly")
+    else:
+        for cookie in args.cookies:
+            cookie_parts = cookie.split(";")
+            for cookie in cookie_parts:
+                if "=" in cookie:
+                    key, value = cookie.split("=", 1)
+                    cookies[key.strip()] = value.strip()
+                else:
+                    logging.warning(f"Invalid cookie (no assigment): {cookie}")
+
+    return url, cookies, headers
+
+def unescape_html(text):
+    return re.sub(r"&#(\d+);", lambda m: chr(int(m.group(1))), text)
+
+
+def extract_decryption_key(key_data):
+    """Decipher the AES key from the base64 data found in the reader page by scan_reader_page()."""
+    if key_data is None:
+        raise Exception("Failed to find the encoded decryption key in the body of Play Book Reader's HTML page")
+
+    try:
+        ciphered_key = base64.b64decode(key_data, validate=True)
+        logging.info(f"Ciphered decryption key: {ciphered_key}")
+    except Exception as e:
+        raise Exception(
+            f"Failed to decode the encoded decryption key from Play Book Reader's HTML page: {key_data[:200]}"
+        ) from e
+
+    return decipher_key(ciphered_key)
+
+
+def decipher_key(str_data):
+    groups = re.findall(r"(\D+\d)", str_data.decode())
+    if len(groups) != 128:
+        logging.warning(
+            f"Unexpected count of AES key groups. Expected: 128, got: {len(groups)}. Ignoring the error and continuing…"
+        )
+
+    bitfield = [str(1 if s[int(s[-1])] == s[-2] else 0) for s in groups]
+    shift = 64 % len(bitfield)
+
+    if shift > 0:
+        bitfield = bitfield[-shift:] + bitfield[:-shift]
+    elif shift < 0:
+        bitfield = bitfield[-shift:] + bitfield[0:-shift]
+
+    key = []
+    for pos in range(0, len(bitfield), 8):
+        bin_str = "".join(reversed(bitfield[pos: pos + 8]))
+        key.append(int(bin_str, 2))
+    return bytes(key)
+
+
+def extract_toc(toc_data):
+    """Parse the table of contents found in the reader page by scan_reader_page()."""
+    if toc_data is None:
+        logging.warning("Failed to extract the table of contents from the book's main page")
+        return None
+
+    try:
+        return json.loads(toc_data)
+    except Exception as e:
+        logging.warning(
+            f"Failed to parse the table of contents from the book's main page as JSON. Content: {toc_data} Error: {e}"
+        )
+        return None
+
+
+def page_download_url(src, rendering=MAX_RENDERING):
+    """URL of the encrypted image of a page, rendered with the w, h and zoom of rendering (see choose_rendering())."""
+    url_parts = list(urlparse(src))
+    query = parse_qs(url_parts[4])
+    query.update(
+        {
+            "w": [str(rendering["w"])],
+            "h": [str(rendering["h"])],
+            "zoom": [str(rendering["zoom"])],
+            "enc_all": ["1"],
+            "img": ["1"],
+        }
+    )
+    url_parts[4] = urlencode(query, doseq=True)
+    return urlunparse(url_parts)
+
+
+def decrypt_stream(chunks, aes_key, output, stats=None):
+    """Decrypt a page whose encrypted content arrives in chunks, and write it to output as it goes."""
+    from Cryptodome.Cipher import AES
+
+    if stats is None:
+        stats = {}
+    stats.setdefault("bytes", 0)
+    stats.setdefault("decrypt_seconds", 0)
+    stats.setdefault("write_seconds", 0)
+
+    pending = bytearray()
+    decrypted = bytearray()
+    cipher = None
+    size = 0
+    sha256 = hashlib.sha256()
+
+    for chunk in chunks:
+        stats["bytes"] += len(chunk)
+        pending += chunk
+
+        if cipher is None:
+            if len(pending) < 16:
+                continue
+            cipher = AES.new(aes_key, AES.MODE_CBC, bytes(pending[:16]))
+            del pending[:16]
+
+        # CBC works on 16 bytes blocks, the remainder is kept for the next chunk
+        usable = len(pending) - len(pending) % 16
+        if usable == 0:
+            continue
+
+        if len(decrypted) < usable:
+            decrypted = bytearray(usable)
+        with memoryview(pending) as src, memoryview(decrypted) as dst:
+            decrypt_start = time.perf_counter()
+            cipher.decrypt(src[:usable], output=dst[:usable])
+            sha256.update(dst[:usable])
+            write_start = time.perf_counter()
+            output.write(dst[:usable])
+            stats["decrypt_seconds"] += write_start - decrypt_start
+            stats["write_seconds"] += time.perf_counter() - write_start
+        size += usable
+        del pending[:usable]
+
+    if cipher is None or pending:
+        raise ValueError(f"Encrypted page has an invalid length ({size + len(pending) + 16} bytes)")
+
+    return size, sha256.hexdigest()
+
+
+def read_image_size(chunks, aes_key):
+    """Return the (width, height) of an encrypted page from the first of its chunks, without reading the rest."""
+    from Cryptodome.Cipher import AES
+    from PIL import ImageFile
+
+    parser = ImageFile.Parser()
+    header = bytearray()
+    pending = bytearray()
+    cipher = None
+    for chunk in chunks:
+        pending += chunk
+        if cipher is None:
+            if len(pending) < 16:
+                continue
+            cipher = AES.new(aes_key, AES.MODE_CBC, bytes(pending[:16]))
+            del pending[:16]
+
+        usable = len(pending) - len(pending) % 16
+        decrypted = cipher.decrypt(bytes(pending[:usable]))
+        del pending[:usable]
+        # Pillow only opens WebP images once they are complete, their size is read from their header instead
+        if len(header) < WEBP_HEADER_SIZE:
+            header += decrypted[:WEBP_HEADER_SIZE - len(header)]
+            if size := webp_size(header):
+                return size
+        parser.feed(decrypted)
+        if parser.image:
+            return parser.image.size
+
+    raise ValueError("Couldn't read the size of the page from its content")
+
+
+def webp_size(header):
+    """Return the (width, height) of a WebP image from its first WEBP_HEADER_SIZE bytes, or None if it isn't one."""
+    if len(header) < WEBP_HEADER_SIZE or header[:4] != b"RIFF" or header[8:12] != b"WEBP":
+        return None
+    chunk = header[12:16]
+    if chunk == b"VP8 ":  # Lossy
+        return (int.from_bytes(header[26:28], "little") & 0x3fff,
+                int.from_bytes(header[28:30], "little") & 0x3fff)
+    if chunk == b"VP8L":  # Lossless
+        bits = int.from_bytes(header[21:25], "little")
+        return (bits & 0x3fff) + 1, (bits >> 14 & 0x3fff) + 1
+    if chunk == b"VP8X":  # Extended, e.g. with an alpha channel
+        return int.from_bytes(header[24:27], "little") + 1, int.from_bytes(header[27:30], "little") + 1
+    return None
+
+
+def mime_to_ext(mime):
+    lookup = {
+        "image/png": "png",
+        "image/jpeg": "jpeg",
+        "image/webp": "webp",
+        "image/apng": "apng",
+        "image/jp2": "jp2",
+        "image/jpx": "jpx",
+        "image/jpm": "jpm",
+        "image/bmp": "bmp",
+        "image/svg+xml": "svg",
+    }
+
+    return lookup.get(mime, "unk")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import codecs
+import logging
+import re
+
+READER_PAGE_CHUNK_SIZE = 16 * 1024
+# Longest data URI accepted for the encoded AES key (it's a few KB) and longest table of contents. Memory usage stays
+# below these bounds whatever the size of the reader page.
+MAX_KEY_LENGTH = 256 * 1024
+MAX_TOC_LENGTH = 16 * 1024 * 1024
+# Text kept between chunks while looking for a marker, so that a marker split between two chunks is still found
+SCAN_OVERLAP = 64
+
+DATA_URI_START = re.compile(r"""src\s*=\s*(["'])data:""")
+TOC_START = re.compile(r'"toc_entry":\s*\[')
+JSON_SPECIAL_CHARACTERS = re.compile(r'["\\\[\]{}]')
+JSON_STRING_SPECIAL_CHARACTERS = re.compile(r'["\\]')
+
+
+def scan_reader_page(response, chunk_size=READER_PAGE_CHUNK_SIZE):
+    """Read the reader page as a stream and return (encoded AES key, table of contents JSON). Missing ones are None."""
+    decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")(errors="replace")
+    key_scanner = KeyScanner()
+    toc_scanner = TocScanner()
+
+    for chunk in response.iter_content(chunk_size):
+        text = decoder.decode(chunk)
+        key_scanner.feed(text)
+        toc_scanner.feed(text)
+        if key_scanner.done and toc_scanner.done:
+            break
+
+    return key_scanner.result, toc_scanner.result
+
+
+class KeyScanner:
+    """Finds the base64 data of the first base64 data URI in a src attribute after <body, fed one chunk at a time."""
+
+    def __init__(self):
+        self.buffer = ""
+        self.in_body = False
+        self.quote = None  # Quote that ends the data URI being read
+        self.result = None
+        self.done = False
+
+    def feed(self, text):
+        if self.done:
+            return
+        self.buffer += text
+
+        while True:
+            if not self.in_body:
+                start = self.buffer.find("<body")
+                if start < 0:
+                    self.buffer = self.buffer[-SCAN_OVERLAP:]
+                    return
+                self.in_body = True
+                self.buffer = self.buffer[start + len("<body"):]
+
+            if self.quote is None:
+                match = DATA_URI_START.search(self.buffer)
+                if not match:
+                    self.buffer = self.buffer[-SCAN_OVERLAP:]
+                    return
+                self.quote = match.group(1)
+                self.buffer = self.buffer[match.end():]
+
+            end = self.buffer.find(self.quote)
+            if end < 0:
+                if len(self.buffer) > MAX_KEY_LENGTH:
+                    logging.warning(f"Skipping a data URI longer than {MAX_KEY_LENGTH} characters in the reader page")
+                    self.quote = None
+                    self.buffer = self.buffer[-SCAN_OVERLAP:]
+                return
+
+            data_uri = self.buffer[:end]
+            self.buffer = self.buffer[end + 1:]
+            self.quote = None
+            if "base64," in data_uri:
+                self.result = data_uri.split("base64,", 1)[1]
+                self.done = True
+                self.buffer = ""
+                return
+
+
+class TocScanner:
+    """Finds the JSON array of "toc_entry", fed one chunk at a time."""
+
+    def __init__(self):
+        self.buffer = ""
+        self.parts = None  # Text of the array read so far, once its start was found
+        self.length = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False  # The previous chunk ended with a backslash inside a string
+        self.result = None
+        self.done = False
+
+    def feed(self, text):
+        if self.done:
+            return
+
+        if self.parts is None:
+            self.buffer += text
+            match = TOC_START.search(self.buffer)
+            if not match:
+                self.buffer = self.buffer[-SCAN_OVERLAP:]
+                return
+            text = self.buffer[match.end() - 1:]  # From the opening bracket of the array
+            self.buffer = ""
+            self.parts = []
+
+        end = self.find_end(text)
+        self.parts.append(text if end is None else text[:end])
+        self.length += len(self.parts[-1])
+
+        if end is not None:
+            self.result = "".join(self.parts)
+            self.parts = []
+            self.done = True
+        elif self.length > MAX_TOC_LENGTH:
+            logging.warning(f"The table of contents in the reader page is longer than {MAX_TOC_LENGTH} characters, "
+                            f"ignoring it")
+            self.parts = []
+            self.done = True
+
+    def find_end(self, text):
+        """Return the position right after the end of the array in text, or None if it doesn't end in text."""
+        position = 0
+        if self.escaped and text:
+            position = 1
+            self.escaped = False
+
+        while True:
+            pattern = JSON_STRING_SPECIAL_CHARACTERS if self.in_string else JSON_SPECIAL_CHARACTERS
+            match = pattern.search(text, position)
+            if not match:
+                return None
+            character = match.group()
+            position = match.end()
+
+            if self.in_string:
+                if character == "\\":
+                    if position < len(text):
+                        position += 1  # Skip the escaped character
+                    else:
+                        self.escaped = True
+                else:
+                    self.in_string = False
+            elif character == '"':
+                self.in_string = True
+            elif character in "[{":
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    return position
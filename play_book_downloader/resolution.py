@@ -0,0 +1,45 @@
+import logging
+import math
+
+# Arbitrarily high size to make sure that we retrieve the highest resolution. Zoom values 1 and 2 are for thumbnails
+# (degraded quality).
+MAX_RENDERING = {"w": 10000, "h": 10000, "zoom": 3}
+PREVIEW_ZOOM = 1  # Fast and small thumbnails, good enough to check the pages of a book
+CSS_DPI = 96  # The default_size of the manifest is the size of the pages on screen, in CSS pixels
+
+
+def choose_rendering(book_id, manifest, probe, target_width=None, target_height=None, target_dpi=None, preview=False):
+    """Return the smallest rendering parameters (w, h and zoom of the page URLs) that meet the target page size."""
+    default_size = manifest.get("default_size") or {}
+
+    if preview:
+        logging.info(f"[{book_id}] Preview mode: downloading low resolution thumbnails of the pages")
+        return {"w": default_size.get("width", 800), "h": default_size.get("height", 1000), "zoom": PREVIEW_ZOOM}
+
+    if target_dpi:
+        if not default_size.get("height"):
+            raise ValueError("The manifest doesn't have the default size of the pages, use a target height instead of "
+                             "a target DPI")
+        target_height = max(target_height or 0, math.ceil(default_size["height"] * target_dpi / CSS_DPI))
+
+    if not target_width and not target_height:
+        return MAX_RENDERING
+
+    native_size = probe()
+    if not native_size:
+        logging.warning(f"[{book_id}] Couldn't find the native resolution of the pages, downloading them at the "
+                        f"highest resolution")
+        return MAX_RENDERING
+
+    native_width, native_height = native_size
+    scale = max((target_width or 0) / native_width, (target_height or 0) / native_height)
+    if scale >= 1:
+        logging.info(f"[{book_id}] The native resolution of the pages ({native_width}x{native_height}) doesn't exceed "
+                     f"the target, downloading them at the highest resolution")
+        return MAX_RENDERING
+
+    rendering = {"w": math.ceil(native_width * scale), "h": math.ceil(native_height * scale),
+                 "zoom": MAX_RENDERING["zoom"]}
+    logging.info(f"[{book_id}] Downloading the pages at {rendering['w']}x{rendering['h']} instead of their native "
+                 f"resolution ({native_width}x{native_height})")
+    return rendering
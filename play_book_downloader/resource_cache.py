@@ -0,0 +1,134 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+RESOURCE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# index.json is written after this many new resources or this many seconds, and by save() at the end of the download
+RESOURCE_CACHE_SAVE_EVERY = 100
+RESOURCE_CACHE_SAVE_INTERVAL = 30
+
+
+class ResourceCache:
+    """Cache of the resources (images, fonts, stylesheets…) referenced by the segments of EPUB books."""
+
+    def __init__(self, directory, max_bytes=RESOURCE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, "index.json")
+        self.lock = threading.Lock()
+        self.unsaved = 0  # Resources added since index.json was written
+        self.saved_at = time.monotonic()
+        self.downloads = {}  # URL -> Future of the resources being downloaded
+
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as index_file:
+                self.index = json.load(index_file)
+        except FileNotFoundError:
+            self.index = {}
+        except ValueError:
+            logging.warning(f"The resource cache index {self.index_path} is corrupted, starting from an empty cache")
+            self.index = {}
+        self.sizes = {entry["sha256"]: entry["size"] for entry in self.index.values()}  # Of the stored resources
+        self.stored_bytes = sum(self.sizes.values())
+
+    def get(self, url, download):
+        """Return (content_type, data) for url. download(url) is only called if the resource isn't cached yet."""
+        with self.lock:
+            entry = self.index.get(url)
+            if entry:
+                try:
+                    with open(self.object_path(entry["sha256"]), "rb") as f:
+                        data = f.read()
+                    entry["last_used"] = time.time()
+                    return entry["content_type"], data
+                except FileNotFoundError:
+                    # Removed from the disk behind our back, download it again
+                    del self.index[url]
+
+            future = self.downloads.get(url)
+            if future is None:
+                future = self.downloads[url] = Future()
+                downloading = True
+            else:
+                downloading = False
+
+        if not downloading:
+            return future.result()
+
+        try:
+            content_type, data = download(url)
+            self.put(url, content_type, data)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result((content_type, data))
+            return content_type, data
+        finally:
+            with self.lock:
+                del self.downloads[url]
+
+    def put(self, url, content_type, data):
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self.object_path(sha256)
+
+        with self.lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(f"{path}.part", "wb") as f:
+                    f.write(data)
+                os.replace(f"{path}.part", path)
+
+            self.index[url] = {"sha256": sha256, "content_type": content_type, "size": len(data),
+                               "last_used": time.time()}
+            if sha256 not in self.sizes:
+                self.sizes[sha256] = len(data)
+                self.stored_bytes += len(data)
+            if self.stored_bytes > self.max_bytes:
+                self.evict()
+            self.unsaved += 1
+            if (self.unsaved >= RESOURCE_CACHE_SAVE_EVERY
+                    or time.monotonic() - self.saved_at >= RESOURCE_CACHE_SAVE_INTERVAL):
+                self.write_index()
+
+    def object_path(self, sha256):
+        return os.path.join(self.directory, "objects", sha256[:2], sha256)
+
+    def evict(self):
+        objects = {}
+        for entry in self.index.values():
+            obj = objects.setdefault(entry["sha256"], {"size": entry["size"], "last_used": 0})
+            obj["last_used"] = max(obj["last_used"], entry["last_used"])
+
+        total = sum(obj["size"] for obj in objects.values())
+        for sha256, obj in sorted(objects.items(), key=lambda item: item[1]["last_used"]):
+            if total <= self.max_bytes:
+                break
+
+            try:
+                os.remove(self.object_path(sha256))
+            except FileNotFoundError:
+                pass
+            self.index = {url: entry for url, entry in self.index.items() if entry["sha256"] != sha256}
+            total -= obj["size"]
+
+        self.sizes = {entry["sha256"]: entry["size"] for entry in self.index.values()}
+        self.stored_bytes = sum(self.sizes.values())
+
+    def save(self):
+        """Write index.json, e.g. with the last use of the resources read since it was last written."""
+        with self.lock:
+            self.write_index()
+
+    def write_index(self):
+        """Write index.json, with self.lock held."""
+        with open(f"{self.index_path}.part", "w", encoding="utf-8") as index_file:
+            json.dump(self.index, index_file, indent=4)
+        os.replace(f"{self.index_path}.part", self.index_path)
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
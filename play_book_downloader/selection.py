@@ -0,0 +1,56 @@
+import argparse
+import logging
+import re
+
+RANGE = re.compile(r"(\d+)(?:\s*-\s*(\d*))?")
+
+
+def parse_selection(text):
+    """Parse a comma separated list of numbers, ranges ("3-7", or "10-" up to the end) and titles."""
+    ranges, titles = [], []
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if match := RANGE.fullmatch(part):
+            first = int(match.group(1))
+            last = first if match.group(2) is None else int(match.group(2)) if match.group(2) else None
+            if first == 0 or last == 0:
+                raise argparse.ArgumentTypeError(f"invalid range '{part}', the numbers start at 1")
+            if last is not None and last < first:
+                raise argparse.ArgumentTypeError(f"invalid range '{part}', it ends before it starts")
+            ranges.append((first, last))
+        else:
+            titles.append(part.lower())
+    if not ranges and not titles:
+        raise argparse.ArgumentTypeError("nothing selected")
+    return ranges, titles
+
+
+def parse_page_ranges(text):
+    """Like parse_selection(), but only numbers and ranges are allowed."""
+    ranges, titles = parse_selection(text)
+    if titles:
+        raise argparse.ArgumentTypeError(f"invalid page range '{titles[0]}', expected e.g. 1-20,45,100-")
+    return ranges
+
+
+def is_selected(number, title, selection):
+    """Whether the chapter with this number and title is selected by a selection from parse_selection()."""
+    ranges, titles = selection
+    return (any(first <= number and (last is None or number <= last) for first, last in ranges)
+            or any(part in title.lower() for part in titles))
+
+
+def priority_order(selected, total, first=()):
+    """Return the indexes to download with the priority ones first, and how many of them are the priority ones."""
+    prioritized = list(dict.fromkeys([*first, *selected]))
+    order = list(dict.fromkeys([*prioritized, *range(total)]))
+    return order, len(prioritized)
+
+
+def log_selection(book_id, selected, total, unit):
+    if not selected:
+        logging.warning(f"[{book_id}] The selection doesn't match any of the {total} {unit} of the book")
+    else:
+        logging.info(f"[{book_id}] Selected {len(selected)} {unit} out of {total}")
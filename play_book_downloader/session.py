@@ -0,0 +1,95 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Can be pointed to a local stand-in server, e.g. for the benchmarks (see benchmarks/stand_in_server.py)
+PLAY_BOOKS_BASE_URL = os.environ.get("PLAY_BOOKS_BASE_URL", "https://play.google.com")
+
+HTTP_POOL_SIZE = 10  # Keep-alive connections kept open to Google Play Books
+HTTP_MAX_RETRIES = 5
+HTTP_BACKOFF_FACTOR = 0.5  # Exponential backoff between retries: 0.5s, 1s, 2s, 4s…
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+# (connect, read) timeouts in seconds, so that a stalled connection is retried instead of blocking its worker forever
+HTTP_TIMEOUT = (10, 60)
+
+
+class RateLimiter:
+    """Spaces out requests so that all the workers together stay below max_rps requests per second."""
+
+    def __init__(self, max_rps):
+        self.interval = 1 / max_rps if max_rps > 0 else 0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+    @contextmanager
+    def request(self):
+        """Wrap each request sent to Google Play Books: waits for the next slot before the request is sent."""
+        self.wait()
+        yield
+
+    def observe(self, response):
+        """Called with each response received inside request(). The fixed rate doesn't use it."""
+
+
+def create_session(cookies, headers, pool_size=HTTP_POOL_SIZE, max_retries=HTTP_MAX_RETRIES,
+                   backoff_factor=HTTP_BACKOFF_FACTOR):
+    """Create the HTTP session shared by all the requests sent to Google Play Books."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=HTTP_RETRY_STATUSES,
+        allowed_methods=frozenset({"GET", "HEAD"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    # pool_block makes the workers wait for a free connection instead of opening throwaway ones
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry, pool_block=True)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.cookies.update(cookies)
+    session.headers.update(headers)
+
+    return session
+
+
+def fetch(session, url, **kwargs):
+    """GET url with the session and raise an HTTPError if the final response is an error."""
+
+    def read_body(response):
+        response.content  # Read the body so that truncated responses are caught and retried
+        return response
+
+    return fetch_streamed(session, url, read_body, **kwargs)
+
+
+def fetch_streamed(session, url, consume, max_retries=HTTP_MAX_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR,
+                   timeout=HTTP_TIMEOUT, **kwargs):
+    """GET url without loading the body in memory and return consume(response)."""
+    from requests.exceptions import ChunkedEncodingError, ConnectionError as RequestsConnectionError
+
+    for attempt in range(max_retries + 1):
+        with session.get(url, stream=True, timeout=timeout, **kwargs) as response:
+            response.raise_for_status()
+            try:
+                return consume(response)
+            except (ChunkedEncodingError, RequestsConnectionError) as e:
+                if attempt == max_retries:
+                    raise
+                logging.warning(f"Connection lost while reading the response (attempt {attempt + 1}/{max_retries + 1}): "
+                                f"{e}")
+        time.sleep(backoff_factor * 2 ** attempt)
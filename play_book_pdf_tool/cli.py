@@ -0,0 +1,66 @@
+import importlib
+
+import click
+
+# Subcommands that are implemented as click commands in other modules: name -> (module:command, short help). The
+# modules are only imported when their subcommand runs, so that the command line starts in milliseconds instead of
+# loading pikepdf, img2pdf, ebooklib… for every command.
+LAZY_COMMANDS = {
+    "build-pdf": ("play_book_pdf_tool.play_book_pdf_tool:pdf_generate", "Build a PDF from the downloaded pages."),
+    "build-epub": ("play_book_pdf_tool.epub_tool:epub_generate", "Build an EPUB from the downloaded segments."),
+    "verify": ("play_book_pdf_tool.verify:pdf_verify", "Check the downloaded pages and re-fetch the bad ones."),
+    "optimize": ("play_book_pdf_tool.optimize:pdf_optimize", "Optimize the downloaded pages."),
+    "pipeline": ("play_book_pdf_tool.pipeline:pdf_pipeline", "Download a book and build its PDF at the same time."),
+}
+# The downloaders parse their own arguments with argparse
+PASSTHROUGH_SETTINGS = {"ignore_unknown_options": True, "allow_interspersed_args": False, "help_option_names": []}
+
+
+class LazyGroup(click.Group):
+    """Group that imports the module of a subcommand from LAZY_COMMANDS only when the subcommand is run."""
+
+    def list_commands(self, ctx):
+        return [*super().list_commands(ctx), *LAZY_COMMANDS]
+
+    def get_command(self, ctx, name):
+        if name not in LAZY_COMMANDS:
+            return super().get_command(ctx, name)
+
+        module_name, command_name = LAZY_COMMANDS[name][0].split(":")
+        return getattr(importlib.import_module(module_name), command_name)
+
+    def format_commands(self, ctx, formatter):
+        rows = [(name, command.get_short_help_str()) for name, command in self.commands.items()]
+        rows += [(name, short_help) for name, (_path, short_help) in LAZY_COMMANDS.items()]
+        with formatter.section("Commands"):
+            formatter.write_dl(rows)
+
+
+@click.group(cls=LazyGroup)
+def cli():
+    """Download Google Play Books and build PDF or EPUB files from them.
+
+    Run play-book COMMAND --help for the options of each command.
+    """
+
+
+@cli.command("download-pdf", context_settings=PASSTHROUGH_SETTINGS, add_help_option=False,
+             short_help="Download the pages of one or several books.")
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+def download_pdf(args):
+    from play_book_downloader.pdf import main
+
+    main(list(args), prog="play-book download-pdf")
+
+
+@cli.command("download-epub", context_settings=PASSTHROUGH_SETTINGS, add_help_option=False,
+             short_help="Download the segments of one or several books as HTML.")
+@click.argument("args", nargs=-1, type=click.UNPROCESSED)
+def download_epub(args):
+    from play_book_downloader.epub import main
+
+    main(list(args), prog="play-book download-epub")
+
+
+if __name__ == "__main__":
+    cli()
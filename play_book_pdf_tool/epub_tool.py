@@ -0,0 +1,177 @@
+import hashlib
+import json
+import logging
+import pathlib
+
+import click
+
+from play_book_downloader.book_store import open_book_store
+
+
+@click.command()
+@click.argument("book-id")
+def epub_generate(book_id: str):
+    """Build an EPUB from the segments of the Google Play Book BOOK-ID, downloaded in books/[BOOK-ID].
+
+    Example: play-book build-epub BwCMEAAAQBAJ
+
+    Note: the segments of the book need to have already been downloaded by google-play-book-downloader-epub.py.
+    """
+    build_epub(book_id)
+
+
+def build_epub(book_id):
+    from ebooklib import epub
+    from ebooklib.epub import EpubBook, EpubHtml, EpubImage, EpubItem, EpubNcx, EpubNav
+    from pydash import _, unescape, trim, curry, replace
+
+    base_path = pathlib.Path(f"books/{book_id}")
+    # The files of the book, or its book.sqlite file when it was downloaded with --store sqlite
+    store = open_book_store(base_path)
+    try:
+        with store.open("manifest.json") as f_xhtml:
+            manifest = json.load(f_xhtml)
+    except FileNotFoundError:
+        logging.error(f"Couldn't find [{store.path('manifest.json')}]! Aborting...")
+        raise
+
+    metadata = manifest["metadata"]
+    volume_id = metadata["volume_id"]
+
+    # TODO: get the ISBN and LCCN by parsing https://books.google.com/books/download?id=Udv-AwAAQBAJ&output=bibtex
+    # Note that the ISBN and LCCN are not always available, for example BwCMEAAAQBAJ doesn't have either
+    # 2014027001 = lccn number from the bibtex (Library of Congress Control Number)
+    # https://lccn.loc.gov/2014027001/marcxml
+    # or https://lccn.loc.gov/2014027001/mods (looks best)
+    # or https://lccn.loc.gov/2014027001/dc (output is a bit weird)
+    # See this for converting marcxml to Dublin Core https://gist.github.com/jermnelson/b1d908044f02032d2953
+    # https://loc.gov/item/2014027001 (embedded JSON in HMTL source is very nice. Search for created_published to find it)
+
+    book = EpubBook()
+
+    # FIXME: use a proper urn:uuid identifier (see real-epub-export-from-google.opf)
+    book.set_identifier(volume_id)
+    book.set_title(metadata["title"])
+
+    _(metadata["authors"]).split(',').map(curry(trim, 1)).map(unescape).for_each(
+        curry(book.add_author, 1)).value()
+
+    book.add_metadata('DC', 'publisher', metadata["publisher"])
+    book.add_metadata('DC', 'date', replace(metadata["pub_date"], ".", "-"))
+    book.add_metadata('DC', 'source',
+                      f"https://books.google.com/books?id={volume_id}")
+    book.add_metadata('DC', 'source',
+                      f"https://play.google.com/store/books/details?id={volume_id}")
+
+    book.set_language(manifest["language"])
+
+    if manifest.get("is_right_to_left"):
+        book.set_direction("rtl")
+
+    # FIXME: we can't assume that the cover will always be PP1.jpeg.
+    #        iirc the cover url is available somewhere and can be easily downloaded
+    with store.open("PP1.jpeg", 'rb') as f:
+        book.set_cover("cover.jpg", f.read())
+
+    # Resources saved as files by the downloader (when it doesn't embed them in the HTML as base64)
+    try:
+        with store.open("resources.json") as f_resources:
+            resources = json.load(f_resources)
+    except FileNotFoundError:
+        resources = {}
+
+    for resource_filename, content_type in resources.items():
+        media_type = content_type.split(";")[0].strip()
+        item_class = EpubImage if media_type.startswith("image/") else EpubItem
+        item = item_class(uid=f"resource_{pathlib.Path(resource_filename).stem}",
+                          file_name=f"resources/{resource_filename}", media_type=media_type)
+        book.add_item(read_when_written(item, store, f"resources/{resource_filename}"))
+
+    chapters = []
+    stylesheets = {}  # sha256 of the CSS -> its item, most segments have the same CSS
+
+    for segment in manifest["segment"]:
+        title = segment["title"]
+        label = segment["label"]
+
+        xhtml_filename = f"{label}.xhtml"
+        css_filename = f"{label}.css"
+
+        try:
+            with store.open(css_filename, "rb") as f:
+                css = f.read()
+            if not store.exists(xhtml_filename):
+                raise FileNotFoundError(xhtml_filename)
+        except FileNotFoundError:
+            logging.error(
+                f"Couldn't find [{store.path(xhtml_filename)} or {store.path(css_filename)}]! Aborting...")
+            raise
+
+        chapter = read_when_written(EpubHtml(title=title, file_name=xhtml_filename), store, xhtml_filename,
+                                    text=True)
+
+        css_hash = hashlib.sha256(css).hexdigest()
+        css_item = stylesheets.get(css_hash)
+        if css_item is None:
+            css_item = EpubItem(uid=f"style_{css_hash[:16]}", file_name=f"style/{css_hash[:16]}.css",
+                                media_type="text/css", content=css)
+            # book.add_item() adds the css file in the EPUB
+            book.add_item(css_item)
+            stylesheets[css_hash] = css_item
+        # chapter.add_item() only adds a link to the css file stored in the EPUB but it doesn't add the css file itself.
+        # Yes, it's super confusing that the latter doesn't do both...
+        chapter.add_item(css_item)
+
+        book.add_item(chapter)
+
+        chapters.append(chapter)
+
+    book.toc = chapters
+
+    # EPUB toc/navigation metadata stuff
+    book.add_item(EpubNcx())
+    book.add_item(EpubNav())
+
+    style = "BODY {color: white;}"
+    nav_css = EpubItem(
+        uid="style_nav",
+        file_name="style/nav.css",
+        media_type="text/css",
+        content=style,
+    )
+
+    book.add_item(nav_css)
+
+    book.spine = ["cover", "nav", *chapters]
+
+    logging.info(f"{len(chapters)} chapters share {len(stylesheets)} distinct stylesheets")
+
+    # The chapters and the resources are read from the store one by one while they are written to the EPUB
+    try:
+        epub.write_epub(f"{base_path}/book.epub", book, {})
+    finally:
+        store.close()
+
+
+def read_when_written(item, store, name, text=False):
+    """Make the ebooklib item read its content from the store only when it's written to the EPUB, and not keep it."""
+    for method_name in ("get_content", "get_body_content"):
+        if hasattr(item, method_name):
+            setattr(item, method_name, with_stored_content(item, getattr(item, method_name), store, name, text))
+    return item
+
+
+def with_stored_content(item, method, store, name, text):
+    def read_and_call(*args, **kwargs):
+        content = store.read(name)
+        item.content = content.decode("utf-8") if text else content
+        try:
+            return method(*args, **kwargs)
+        finally:
+            item.content = ""
+
+    return read_and_call
+
+
+if __name__ == "__main__":
+    epub_generate()
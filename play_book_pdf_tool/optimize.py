@@ -0,0 +1,133 @@
+import hashlib
+import io
+import logging
+import os
+import pathlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+
+from play_book_downloader.book_store import image_name, open_book_store, read_image
+
+OPTIMIZER_VERSION = 2  # Bump when the optimization changes so that the cached pages are optimized again
+GRAYSCALE_MAX_CHANNEL_DIFFERENCE = 8  # Color pages whose channels differ by at most this much are treated as gray
+BILEVEL_MAX_MIDTONE_RATIO = 0.02  # Text pages have almost no pixels that are neither close to black nor to white
+BILEVEL_THRESHOLD = 128
+# Gray pages with more midtones than this are photos or illustrations, which a reduced palette would posterize
+PHOTO_MIN_MIDTONE_RATIO = 0.15
+GRAYSCALE_PALETTE_COLORS = 16
+
+
+@click.command()
+@click.argument(
+    "book-base-path",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True, writable=True,
+                    readable=True, path_type=pathlib.Path),
+)
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=os.cpu_count(), show_default=True,
+              help="Number of processes optimizing the pages.")
+def pdf_optimize(book_base_path: pathlib.Path, jobs: int):
+    """Optimize the Google Play Book pages located in the directory BOOK-BASE-PATH.
+
+    Example: play-book-pdf-optimize "books/BwCMEAAAQBAJ"
+
+    Note: the optimized pages are cached in BOOK-BASE-PATH/optimized, where play-book-pdf-build --optimize reads them.
+    """
+    store = open_book_store(book_base_path)
+    try:
+        with store.open("pages.txt") as pages_file:
+            page_paths = [store.image(fn) for fn in pages_file.read().splitlines()]
+    finally:
+        store.close()
+
+    optimize_pages(page_paths, book_base_path / "optimized", jobs)
+
+
+def optimize_pages(page_paths, cache_dir, jobs=None):
+    """Return the paths of the optimized pages, in the same order as page_paths."""
+    os.makedirs(cache_dir, exist_ok=True)
+
+    print(f"Optimizing {len(page_paths)} pages...")
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(optimize_page, page_paths, [str(cache_dir)] * len(page_paths), chunksize=8))
+
+    codecs = {}
+    for _path, codec, _original_size, _size in results:
+        codecs[codec] = codecs.get(codec, 0) + 1
+    original_size = sum(result[2] for result in results)
+    size = sum(result[3] for result in results)
+    print(f"Optimized the pages from {original_size / 1024 / 1024:.1f} MB to {size / 1024 / 1024:.1f} MB "
+          f"({', '.join(f'{count} {codec}' for codec, count in sorted(codecs.items()))})")
+
+    return [result[0] for result in results]
+
+
+def optimize_page(page_path, cache_dir):
+    """Optimize a page (path or StoredImage) and return (path, codec, original size, optimized size)."""
+    from PIL import Image
+
+    page_data = read_image(page_path)
+    original_size = len(page_data)
+    page_hash = hashlib.sha256(page_data).hexdigest()
+    cache_key = f"{page_hash}-v{OPTIMIZER_VERSION}"
+
+    for codec in ("bilevel", "grayscale"):
+        cached_path = os.path.join(cache_dir, f"{cache_key}-{codec}.png")
+        if os.path.exists(cached_path):
+            return cached_path, codec, original_size, os.path.getsize(cached_path)
+    # Marks the pages that are better left untouched
+    keep_path = os.path.join(cache_dir, f"{cache_key}-original")
+    if os.path.exists(keep_path):
+        return page_path, "original", original_size, original_size
+
+    try:
+        with Image.open(io.BytesIO(page_data)) as image:
+            codec, optimized_image = optimize_image(image)
+    except Exception as e:
+        logging.warning(f"Couldn't optimize [{image_name(page_path)}], keeping it as it is: {e}")
+        codec, optimized_image = "original", None
+
+    if optimized_image is not None:
+        optimized_path = os.path.join(cache_dir, f"{cache_key}-{codec}.png")
+        # Identical pages (e.g. blank ones) can be optimized by several processes at once, each writes its own file
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".part", delete=False) as part_file:
+            optimized_image.save(part_file, format="PNG", optimize=True)
+        if os.path.getsize(part_file.name) < original_size:
+            os.replace(part_file.name, optimized_path)
+            return optimized_path, codec, original_size, os.path.getsize(optimized_path)
+        os.remove(part_file.name)
+
+    pathlib.Path(keep_path).touch()
+    return page_path, "original", original_size, original_size
+
+
+def optimize_image(image):
+    """Pick the codec for the image and return (codec, optimized image). The image is None for "original"."""
+    from PIL import Image, ImageChops, ImageStat
+
+    if image.mode == "1":
+        return "original", None
+
+    if image.mode not in ("L", "LA"):
+        rgb = image.convert("RGB")
+        red, green, blue = rgb.split()
+        max_difference = max(ImageStat.Stat(ImageChops.difference(a, b)).extrema[0][1]
+                             for a, b in ((red, green), (green, blue), (red, blue)))
+        if max_difference > GRAYSCALE_MAX_CHANNEL_DIFFERENCE:
+            return "original", None  # Color page, e.g. a photo
+
+    gray = image.convert("L")
+
+    histogram = gray.histogram()
+    midtone_ratio = sum(histogram[64:192]) / (gray.width * gray.height)
+    if midtone_ratio <= BILEVEL_MAX_MIDTONE_RATIO:
+        return "bilevel", gray.point(lambda value: 255 if value >= BILEVEL_THRESHOLD else 0, mode="1")
+    if midtone_ratio > PHOTO_MIN_MIDTONE_RATIO:
+        return "original", None  # Black and white photo or illustration
+
+    return "grayscale", gray.quantize(colors=GRAYSCALE_PALETTE_COLORS, dither=Image.Dither.NONE)
+
+
+if __name__ == "__main__":
+    pdf_optimize()
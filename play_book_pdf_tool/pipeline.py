@@ -0,0 +1,185 @@
+import logging
+import os
+import pathlib
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import click
+
+from play_book_downloader.adaptive import save_rate_limiter
+from play_book_downloader.batch import BatchScheduler, log_summary
+from play_book_downloader.book_store import open_book_store, BOOK_STORES
+from play_book_downloader.credentials import CREDENTIALS_WAIT_TIMEOUT
+from play_book_downloader.metadata_cache import METADATA_CACHE_TTL
+from play_book_downloader.metrics import MetricsRecorder, StageProfiler, PROFILE_DIR
+from play_book_downloader.pdf import create_credential_manager, create_rate_limiter, download_book, \
+    read_curl_credentials, GOOGLE_MAX_REQUESTS_PER_SECOND, GOOGLE_PAGE_DOWNLOAD_WORKERS
+from play_book_downloader.session import create_session, HTTP_POOL_SIZE
+from play_book_pdf_tool.optimize import optimize_page
+from play_book_pdf_tool.play_book_pdf_tool import PdfBuilder, order_pages, add_metadata, add_toc, \
+    generate_output_pdf_filename, format_peak_rss
+
+# Pages downloaded but not yet picked up by the PDF build. When it's full the downloader waits for the build to catch up.
+PIPELINE_QUEUE_SIZE = 64
+DOWNLOAD_FINISHED = object()  # Put on the queue after the last page
+
+
+@click.command()
+@click.argument("book-id")
+@click.option("--workers", type=click.IntRange(min=1), default=GOOGLE_PAGE_DOWNLOAD_WORKERS, show_default=True,
+              help="Maximum number of pages downloaded in parallel.")
+@click.option("--max-rps", type=float, default=GOOGLE_MAX_REQUESTS_PER_SECOND, show_default=True,
+              help="Maximum number of page requests per second.")
+@click.option("--fixed-rate", is_flag=True,
+              help="Always send --max-rps requests per second with --workers in parallel, instead of adapting the rate "
+                   "to the responses of Google Play Books.")
+@click.option("--pool-size", type=click.IntRange(min=1), default=HTTP_POOL_SIZE, show_default=True,
+              help="Number of HTTP connections kept open to Google Play Books.")
+@click.option("--credentials-timeout", type=float, default=CREDENTIALS_WAIT_TIMEOUT, show_default=True,
+              help="When the cookies expire during the download, pause it and wait this many seconds for a new cURL "
+                   "command in curl.txt before giving up, 0 to fail right away.")
+@click.option("--metadata-ttl", type=float, default=METADATA_CACHE_TTL, show_default=True,
+              help="Reuse the AES key and the manifest of the previous run while they are younger than this many "
+                   "seconds.")
+@click.option("--store", "store_backend", type=click.Choice(BOOK_STORES),
+              help="Save the pages as files in the book folder, or all together in a single book.sqlite file (faster "
+                   "on network storage). Defaults to the store the book already has, or files.")
+@click.option("--optimize", is_flag=True,
+              help="Optimize the pages while they are downloaded (see play-book-pdf-optimize).")
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=os.cpu_count(), show_default=True,
+              help="Number of processes optimizing the pages.")
+@click.option("--linearize/--no-linearize", default=False,
+              help="Optimize the PDF for fast web view. This takes an extra pass over the whole PDF.")
+@click.option("--metrics", "metrics_path", type=click.Path(dir_okay=False, path_type=pathlib.Path),
+              help="Write metrics for each page to this file (JSON lines) and a Prometheus summary next to it.")
+@click.option("--profile", is_flag=True,
+              help=f"Profile each stage with cProfile and tracemalloc, the results are saved in {PROFILE_DIR}/.")
+def pdf_pipeline(book_id: str, workers: int, max_rps: float, fixed_rate: bool, pool_size: int,
+                 credentials_timeout: float, metadata_ttl: float, store_backend: str, optimize: bool, jobs: int,
+                 linearize: bool, metrics_path: pathlib.Path, profile: bool):
+    """Download the Google Play Book BOOK-ID and build its PDF at the same time.
+
+    Example: play-book-pdf-pipeline BwCMEAAAQBAJ
+
+    Note: like google-play-book-downloader-pdf.py, it needs curl.txt and saves the pages in books/[BOOK_ID].
+    """
+    start_time = time.perf_counter()
+
+    cookies, headers = read_curl_credentials()
+    session = create_session(cookies, headers, pool_size=pool_size)
+    rate_limiter = create_rate_limiter(cookies, max_rps, workers, fixed_rate)
+    metrics = MetricsRecorder(metrics_path)
+    profiler = StageProfiler(PROFILE_DIR if profile else None, metrics)
+    scheduler = BatchScheduler(session, rate_limiter, workers, metrics=metrics, profiler=profiler,
+                               credentials=create_credential_manager(session, credentials_timeout))
+
+    book_base_path = pathlib.Path("books") / book_id
+    store = open_book_store(book_base_path, store_backend)
+    pages = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    cancelled = threading.Event()
+    results = {}
+
+    def put(item):
+        # Give up when the build failed, instead of waiting forever for it to make room in the queue
+        while not cancelled.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+        raise RuntimeError("The PDF build failed")
+
+    def download(book_id, scheduler):
+        try:
+            return download_book(book_id, scheduler, metadata_ttl,
+                                 lambda manifest, index, filename: put((manifest, index, filename)),
+                                 store_backend=store_backend)
+        finally:
+            if not cancelled.is_set():
+                put(DOWNLOAD_FINISHED)
+
+    def run_download():
+        results.update(scheduler.run([book_id], download))
+
+    download_thread = threading.Thread(target=run_download)
+    download_thread.start()
+
+    try:
+        with profiler.stage("pipeline"):
+            output_pdf = build_pdf(book_base_path, store, pages, metrics, profiler, optimize, jobs, linearize)
+    except BaseException:
+        cancelled.set()
+        raise
+    finally:
+        download_thread.join()
+        store.close()
+        metrics.close()
+        if not fixed_rate:
+            save_rate_limiter(rate_limiter, cookies)
+
+    log_summary(results)
+    if output_pdf is None:
+        logging.error("The PDF wasn't built because the download is incomplete. Run the same command again to resume "
+                      "it, the pages that were already downloaded are skipped.")
+        sys.exit(1)
+
+    print(f'Done! PDF saved to "{str(output_pdf)}"')
+    print(f"Total time: {time.perf_counter() - start_time:.1f}s, peak memory usage: {format_peak_rss()}")
+
+
+def build_pdf(book_base_path, store, pages, metrics, profiler, optimize, jobs, linearize):
+    """Build the PDF from the (manifest, index, filename) of the pages put on the pages queue by the downloader."""
+    manifest = None
+    order = []  # Index in the manifest of each page of the PDF
+    ready = {}  # Index in the manifest -> image of the page (path or StoredImage), or future of its optimization
+    missing = 0
+    next_position = 0
+
+    cache_dir = book_base_path / "optimized"
+    optimizer = ProcessPoolExecutor(max_workers=jobs) if optimize else None
+    if optimize:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    with PdfBuilder(metrics) as builder:
+        try:
+            while (item := pages.get()) is not DOWNLOAD_FINISHED:
+                page_manifest, index, filename = item
+                if manifest is None:
+                    manifest = page_manifest
+                    order = order_pages(manifest, list(range(len(manifest["page"]))))
+                if filename is None:
+                    missing += 1
+                    continue
+
+                page_path = store.image(filename)
+                ready[index] = optimizer.submit(optimize_page, page_path, str(cache_dir)) if optimizer else page_path
+
+                # Add all the pages that can be added in order
+                while next_position < len(order) and order[next_position] in ready:
+                    page = ready.pop(order[next_position])
+                    builder.append_image(page.result()[0] if isinstance(page, Future) else page)
+                    next_position += 1
+        finally:
+            if optimizer:
+                optimizer.shutdown(cancel_futures=True)
+
+        if manifest is None or missing or next_position < len(order):
+            return None
+
+        print("Adding the metadata and the table of contents...")
+        with profiler.stage("metadata"):
+            add_metadata(manifest, builder.pdf)
+            add_toc(store, manifest, builder.pdf)
+
+        output_pdf = book_base_path / generate_output_pdf_filename(manifest)
+        with profiler.stage("save"):
+            builder.pdf.save(str(output_pdf), linearize=linearize)
+
+    return output_pdf
+
+
+if __name__ == "__main__":
+    pdf_pipeline()
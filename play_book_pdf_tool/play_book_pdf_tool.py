@@ -1,5 +1,8 @@
+import contextlib
+import io
 import os
 import pathlib
+import time
 import unicodedata
 from operator import itemgetter
 import datetime
@@ -7,11 +10,20 @@ import json
 import logging
 import re
 import html
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 import click
-from pikepdf import Pdf, OutlineItem
-import img2pdf
-from pydash import _
+
+from play_book_downloader.book_store import image_name, image_size, open_book_store, open_image, read_image
+from play_book_downloader.metrics import MetricsRecorder, StageProfiler, PROFILE_DIR
+from play_book_pdf_tool.optimize import optimize_pages
+
+PDF_BUILD_CHUNK_SIZE = 100  # Number of pages per sub-PDF when the build is split between several processes
+# Written next to the PDF, with the hash of the image of each of its pages, to only replace the pages that changed on
+# the next build
+PAGE_INDEX_SUFFIX = ".pages.json"
 
 logging.basicConfig(format="[%(levelname)s] %(message)s")
 logging.getLogger().setLevel(logging.INFO)
@@ -23,79 +35,350 @@ logging.getLogger().setLevel(logging.INFO)
     type=click.Path(exists=True, file_okay=False, dir_okay=True, writable=True,
                     readable=True, path_type=pathlib.Path),
 )
-def pdf_generate(book_base_path: pathlib.Path):
+@click.option("--linearize/--no-linearize", default=False,
+              help="Optimize the PDF for fast web view. This takes an extra pass over the whole PDF.")
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=1,
+              help="Number of processes converting the pages. With more than 1 the pages are converted to sub-PDFs of --chunk-size pages in parallel, which are then merged.")
+@click.option("--chunk-size", type=click.IntRange(min=1), default=PDF_BUILD_CHUNK_SIZE, show_default=True,
+              help="Number of pages per sub-PDF when --jobs is more than 1.")
+@click.option("--optimize", is_flag=True,
+              help="Optimize the pages before building the PDF (see play-book-pdf-optimize). The optimized pages are cached.")
+@click.option("--incremental/--no-incremental", default=True,
+              help="When the PDF was already built, only replace the pages whose image changed since then (e.g. after "
+                   "play-book-pdf-verify --refetch) instead of building it again from scratch.")
+@click.option("--metrics", "metrics_path", type=click.Path(dir_okay=False, path_type=pathlib.Path),
+              help="Write metrics for each page to this file (JSON lines) and a Prometheus summary next to it.")
+@click.option("--profile", is_flag=True,
+              help=f"Profile each stage with cProfile and tracemalloc, the results are saved in {PROFILE_DIR}/.")
+def pdf_generate(book_base_path: pathlib.Path, linearize: bool, jobs: int, chunk_size: int, optimize: bool,
+                 incremental: bool, metrics_path: pathlib.Path, profile: bool):
     """Build a PDF from the Google Play Book pages located in the directory BOOK-BASE-PATH.
 
     Example: play-book-pdf-build "books/BwCMEAAAQBAJ"
 
     Note: the pages of the book need to have already been downloaded prior to running this command.
     """
+    start_time = time.perf_counter()
+
+    store = open_book_store(book_base_path)
+    manifest = read_manifest(store)
+
+    with store.open("pages.txt") as pages_file:
+        pages_filename = pages_file.read().splitlines()
+
+    pages_filename = order_pages(manifest, pages_filename)
+
+    page_paths = list(map(store.image, pages_filename))
+    output_pdf = book_base_path / generate_output_pdf_filename(manifest)
 
+    metrics = MetricsRecorder(metrics_path)
+    profiler = StageProfiler(PROFILE_DIR if profile else None, metrics)
+
+    try:
+        page_index = read_page_index(output_pdf)
+        page_versions = hash_pages(store, pages_filename, page_index.get("versions", {}) if page_index else {})
+        page_hashes = [page_versions[name][1] for name in pages_filename]
+        changed = find_changed_pages(output_pdf, page_index, page_hashes, optimize) if incremental else None
+        if changed == []:
+            print(f'No page changed since "{str(output_pdf)}" was built. Pass --no-incremental to build it again.')
+            return
+        if changed is not None:
+            page_paths = [page_paths[n] for n in changed]
+
+        if optimize:
+            with profiler.stage("optimize"):
+                page_paths = optimize_pages(page_paths, book_base_path / "optimized", jobs)
+
+        if changed is not None:
+            print(f"Replacing {len(changed)} changed pages out of {len(page_hashes)} in the existing PDF...")
+            with profiler.stage("update"):
+                update_pdf(output_pdf, dict(zip(changed, page_paths)), store, manifest, linearize, metrics)
+        else:
+            print(f"Merging {len(page_paths)} pages... (this can take a long time)")
+
+            # The pages, the metadata and the table of contents are all added before the PDF is written, so that it's
+            # only written once
+            with tempfile.TemporaryDirectory(dir=book_base_path, prefix=".pdf-chunks-") as chunk_dir:
+                with profiler.stage("convert"):
+                    builder = create_pdf(page_paths, jobs, chunk_size, chunk_dir, metrics)
+
+                with builder:
+                    print("Adding the metadata and the table of contents...")
+                    with profiler.stage("metadata"):
+                        add_metadata(manifest, builder.pdf)
+                        add_toc(store, manifest, builder.pdf)
+
+                    with profiler.stage("save"):
+                        builder.pdf.save(str(output_pdf), linearize=linearize)
+        write_page_index(output_pdf, page_hashes, page_versions, optimize)
+    finally:
+        metrics.close()
+        store.close()
+
+    print(f'Done! PDF saved to "{str(output_pdf)}"')
+    print(f"Build time: {time.perf_counter() - start_time:.1f}s, peak memory usage: {format_peak_rss()}")
+
+
+def read_manifest(store):
     try:
-        with open(f"{book_base_path}/manifest.json") as f_manifest:
-            manifest = json.load(f_manifest)
+        with store.open("manifest.json") as f_manifest:
+            return json.load(f_manifest)
     except FileNotFoundError:
         logging.error(
-            f"Couldn't find [{f'{book_base_path}/manifest.json'}]! Aborting...")
+            f"Couldn't find [{store.path('manifest.json')}]! Aborting...")
         raise
 
-    pages_filename = pathlib.Path(book_base_path / "pages.txt").read_text(
-        encoding="UTF-8").splitlines()
+
+def order_pages(manifest, pages):
+    """Return the pages in the order they must have in the PDF."""
+    from pydash import _
 
     if manifest.get("is_right_to_left"):
         logging.info(
             "the manifest indicates that the book pages are ordered right to left. We will swap the order of the pages so that they show correctly in the PDF."
         )
 
-        front = _.head(pages_filename)
-        back = _.last(pages_filename)
+        front = _.head(pages)
+        back = _.last(pages)
 
-        reversed_middle = _(pages_filename).initial().tail().chunk(2).map(
+        reversed_middle = _(pages).initial().tail().chunk(2).map(
             _.reverse).flatten()
 
-        pages_filename = reversed_middle.unshift(front).push(back).value()
+        pages = reversed_middle.unshift(front).push(back).value()
+
+    return pages
+
+
+class PdfBuilder:
+    """Builds a PDF in memory page by page from images, so that it can be written in a single pass once complete."""
+
+    def __init__(self, metrics=None):
+        from pikepdf import Pdf
+
+        self.pdf = Pdf.new()
+        self.page_sources = []
+        self.metrics = metrics or MetricsRecorder()
+
+    def append_image(self, image):
+        import img2pdf
+        from pikepdf import Pdf
+
+        start_time = time.perf_counter()
+        page_pdf = Pdf.open(io.BytesIO(img2pdf.convert(read_image(image))))
+        self.pdf.pages.append(page_pdf.pages[0])
+        self.page_sources.append(page_pdf)
+        self.metrics.record("pdf_page", path=image_name(image), bytes=image_size(image),
+                            convert_seconds=time.perf_counter() - start_time)
+
+    def append_pdf(self, pdf_path):
+        """Append all the pages of another PDF, e.g. a sub-PDF built by create_chunk_pdf()."""
+        from pikepdf import Pdf
+
+        start_time = time.perf_counter()
+        source_pdf = Pdf.open(pdf_path)
+        self.pdf.pages.extend(source_pdf.pages)
+        self.page_sources.append(source_pdf)
+        self.metrics.record("pdf_chunk_merge", path=str(pdf_path), pages=len(source_pdf.pages),
+                            merge_seconds=time.perf_counter() - start_time)
+
+    def close(self):
+        self.pdf.close()
+        for page_pdf in self.page_sources:
+            page_pdf.close()
+        self.page_sources = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def create_pdf(images, jobs=1, chunk_size=PDF_BUILD_CHUNK_SIZE, chunk_dir=None, metrics=None):
+    """Return a PdfBuilder with one page per image (path or StoredImage), in the same order."""
+    for image in images:
+        if image_size(image) == 0:
+            raise ValueError(f"image at path [{image_name(image)}] is empty")
+        if isinstance(image, str):
+            # test-read a byte from it so that we can abort early in case
+            # we cannot read data from the file
+            with open(image, "rb") as im:
+                im.read(1)
 
-    page_paths = list(map(lambda fn: str(book_base_path / fn), pages_filename))
+    builder = PdfBuilder(metrics)
 
-    print(f"Merging {len(page_paths)} pages... (this can take a long time)")
+    if jobs <= 1:
+        for image in images:
+            builder.append_image(image)
+        return builder
 
-    tmp_pdf = book_base_path / "book-tmp.pdf"
-    create_pdf(page_paths, tmp_pdf)
+    chunks = [images[i:i + chunk_size] for i in range(0, len(images), chunk_size)]
+    chunk_paths = [os.path.join(chunk_dir, f"chunk-{n:05}.pdf") for n in range(len(chunks))]
 
-    print("Adding the metadata and the table of contents...")
-    with Pdf.open(tmp_pdf) as pdf:
-        add_metadata(book_base_path, pdf)
-        add_toc(book_base_path, pdf)
+    print(f"Converting the pages in {len(chunks)} chunks with {jobs} processes...")
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # map() returns the results in the order of the chunks, whichever process finishes first
+        for chunk_path, convert_seconds in executor.map(create_chunk_pdf, chunks, chunk_paths):
+            builder.metrics.record("pdf_chunk", path=chunk_path, convert_seconds=convert_seconds)
+            builder.append_pdf(chunk_path)
 
-        filename = generate_output_pdf_filename(book_base_path)
-        output_pdf = book_base_path / filename
-        pdf.save(str(output_pdf), linearize=True)
+    return builder
 
-        tmp_pdf.unlink()
 
-        print(f'Done! PDF saved to "{str(output_pdf)}"')
+def create_chunk_pdf(images, chunk_path):
+    import img2pdf
 
+    start_time = time.perf_counter()
+    with contextlib.ExitStack() as stack, open(chunk_path, "wb") as chunk_pdf:
+        img2pdf.convert(*[stack.enter_context(open_image(image)) for image in images], outputstream=chunk_pdf)
+    return chunk_path, time.perf_counter() - start_time
 
-def create_pdf(image_paths, output_pdf_path):
-    for path in image_paths:
-        if os.path.getsize(path) == 0:
-            raise f"image at path [{path}] is empty"
-        # test-read a byte from it so that we can abort early in case
-        # we cannot read data from the file
-        with open(path, "rb") as im:
-            im.read(1)
 
-    output_pdf = open(output_pdf_path, "wb")
-    img2pdf.convert(*image_paths, outputstream=output_pdf)
+def page_index_path(output_pdf):
+    return pathlib.Path(output_pdf).with_suffix(PAGE_INDEX_SUFFIX)
 
 
-def generate_output_pdf_filename(base_path):
+def write_page_index(output_pdf, page_hashes, page_versions, optimize):
+    """Record the hash of the image of each page of the PDF just saved, and what the next build has to check it with."""
+    index_path = page_index_path(output_pdf)
+    with open(f"{index_path}.part", "w", encoding="utf-8") as f:
+        json.dump({"pdf_size": os.path.getsize(output_pdf), "optimize": optimize, "pages": page_hashes,
+                   "versions": page_versions}, f)
+    os.replace(f"{index_path}.part", index_path)
+
+
+def read_page_index(output_pdf):
+    """Return the page index written by the previous build, or None if there isn't any."""
     try:
-        with open(f"{base_path}/manifest.json") as f_manifest:
-            manifest = json.load(f_manifest)
-    except FileNotFoundError:
-        logging.error(f"Couldn't find [{f'{base_path}/manifest.json'}]! Aborting...")
-        raise
+        with open(page_index_path(output_pdf), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def hash_pages(store, pages, known_versions):
+    """Return a dict with the version and the hash of the image of each page, as [version, sha256]."""
+    page_versions = {}
+    for page in pages:
+        version = store.version(page)
+        known_version, sha256 = known_versions.get(page, (None, None))
+        page_versions[page] = [version, sha256 if version == known_version else store.sha256(page)]
+    return page_versions
+
+
+def find_changed_pages(output_pdf, index, page_hashes, optimize):
+    """Return the indexes of the pages whose image changed since the last build, or None if it must be built again."""
+    try:
+        pdf_size = os.path.getsize(output_pdf)
+    except OSError:
+        return None
+    if index is None:
+        return None
+
+    if (index.get("pdf_size") != pdf_size or index.get("optimize") != optimize
+            or len(index.get("pages", [])) != len(page_hashes)):
+        logging.info("The existing PDF doesn't match its page index, building it again from scratch")
+        return None
+
+    return [n for n, (old, new) in enumerate(zip(index["pages"], page_hashes)) if old != new]
+
+
+def update_pdf(output_pdf, changed_images, store, manifest, linearize=False, metrics=None):
+    """Replace some pages of an existing PDF. changed_images maps the index of each page to its new image."""
+    import img2pdf
+    from pikepdf import Pdf
+
+    metrics = metrics or MetricsRecorder()
+    xref_offset = None if linearize else find_xref_table(output_pdf)
+    page_sources = []
+    try:
+        with Pdf.open(output_pdf, allow_overwriting_input=xref_offset is None) as pdf:
+            size = int(pdf.trailer.Size)
+            replaced = {}
+            for n, image in changed_images.items():
+                start_time = time.perf_counter()
+                page_pdf = Pdf.open(io.BytesIO(img2pdf.convert(read_image(image))))
+                page_sources.append(page_pdf)  # Has to stay open until the PDF is saved
+                if xref_offset is None:
+                    pdf.pages[n] = page_pdf.pages[0]
+                else:
+                    page = pdf.copy_foreign(page_pdf.pages[0].obj)  # Copied without its /Parent
+                    page.Parent = pdf.pages[n].obj.Parent
+                    replaced[pdf.pages[n].obj.objgen] = page
+                metrics.record("pdf_page", path=image_name(image), bytes=image_size(image),
+                               convert_seconds=time.perf_counter() - start_time)
+
+            if xref_offset is None:
+                add_metadata(manifest, pdf)
+                add_toc(store, manifest, pdf)
+                pdf.save(output_pdf, linearize=linearize)
+                return
+            update = incremental_update(pdf, replaced, size, xref_offset, os.path.getsize(output_pdf))
+    finally:
+        for page_pdf in page_sources:
+            page_pdf.close()
+
+    with open(output_pdf, "ab") as f:
+        f.write(update)
+
+
+def find_xref_table(pdf_path):
+    """Return the offset of the last cross-reference table of the PDF, or None for a cross-reference stream."""
+    with open(pdf_path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 1024))
+        match = re.search(rb"startxref\s+(\d+)\s+%%EOF\s*$", f.read())
+        if not match:
+            return None
+        f.seek(int(match.group(1)))
+        return int(match.group(1)) if f.read(4) == b"xref" else None
+
+
+def incremental_update(pdf, replaced, size, xref_offset, pdf_size):
+    """Return the bytes to append to the PDF: the objects added since it was opened and the replaced pages."""
+    from pikepdf import Dictionary, Stream
+
+    new_pages = {page.objgen for page in replaced.values()}
+    objects = {objgen: page for objgen, page in replaced.items()}
+    objects.update((obj.objgen, obj) for obj in pdf.objects
+                   if obj.objgen[0] >= size and obj.objgen not in new_pages)
+
+    update = io.BytesIO()
+    update.write(b"\n")
+    offsets = {}
+    for (number, generation), obj in sorted(objects.items()):
+        offsets[number] = (pdf_size + update.tell(), generation)
+        update.write(b"%d %d obj\n" % (number, generation))
+        if isinstance(obj, Stream):
+            data = obj.read_raw_bytes()
+            stream_dict = Dictionary({**obj.stream_dict, "/Length": len(data)})
+            update.write(stream_dict.unparse() + b"\nstream\n" + data + b"\nendstream")
+        else:
+            update.write(obj.unparse(resolved=True))
+        update.write(b"\nendobj\n")
+
+    xref_start = pdf_size + update.tell()
+    update.write(b"xref\n")
+    numbers = sorted(offsets)
+    first = 0
+    for i, number in enumerate(numbers):
+        # One subsection per run of consecutive object numbers
+        if i + 1 == len(numbers) or numbers[i + 1] != number + 1:
+            update.write(b"%d %d\n" % (numbers[first], i + 1 - first))
+            for subsection_number in numbers[first:i + 1]:
+                update.write(b"%010d %05d n \n" % offsets[subsection_number])
+            first = i + 1
+
+    trailer = Dictionary(Size=max(size, numbers[-1] + 1), Root=pdf.trailer.Root, Prev=xref_offset)
+    for key in ("/Info", "/ID"):
+        if key in pdf.trailer:
+            trailer[key] = pdf.trailer[key]
+    update.write(b"trailer\n" + trailer.unparse() + b"\nstartxref\n%d\n%%%%EOF\n" % xref_start)
+    return update.getvalue()
+
+
+def generate_output_pdf_filename(manifest):
+    from pydash import _
 
     m = _(manifest)
 
@@ -107,13 +390,8 @@ def generate_output_pdf_filename(base_path):
     return to_valid_filename(filename) + ".pdf"
 
 
-def add_metadata(base_path, pdf):
-    try:
-        with open(f"{base_path}/manifest.json") as f_manifest:
-            manifest = json.load(f_manifest)
-    except FileNotFoundError:
-        logging.error(f"Couldn't find [{f'{base_path}/manifest.json'}]! Aborting...")
-        raise
+def add_metadata(manifest, pdf):
+    from pydash import _
 
     with pdf.open_metadata() as pdf_metadata:
         m = _(manifest)
@@ -162,22 +440,19 @@ def add_metadata(base_path, pdf):
         #
 
 
-def add_toc(book_base_path, pdf):
+def add_toc(store, manifest, pdf):
+    from pikepdf import OutlineItem
+
     try:
-        with open(book_base_path / "toc.json") as f_toc:
+        with store.open("toc.json") as f_toc:
             toc = json.load(f_toc)
     except FileNotFoundError:
         logging.error(
             "Couldn't find toc.json! Falling back to manifest.json. The outline structure will be flat...")
-        try:
-            with open(book_base_path / "manifest.json") as f_toc:
-                toc = json.load(f_toc)["toc_entry"]
-        except FileNotFoundError:
-            logging.error("Couldn't find manifest.json either! Aborting...")
-            raise
+        toc = manifest.get("toc_entry")
 
     if toc is None or len(toc) == 0:
-        raise "No table of contents or no entries"
+        raise ValueError("No table of contents or no entries")
 
     with pdf.open_outline() as pdf_outline:
         pdf_outline.root.clear()
@@ -195,6 +470,18 @@ def add_toc(book_base_path, pdf):
             parent.append(outline_item)
 
 
+def format_peak_rss():
+    try:
+        import resource
+    except ImportError:  # Not available on Windows
+        return "unknown"
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    peak_rss_mb = peak_rss / 1024 / 1024 if sys.platform == "darwin" else peak_rss / 1024
+    return f"{peak_rss_mb:.0f} MB"
+
+
 def to_valid_filename(value):
     value = unicodedata.normalize("NFKC", value)
     value = re.sub(r"[^\w\s\-.,—()]", "", value).strip("-_")
@@ -0,0 +1,184 @@
+import collections
+import hashlib
+import io
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+
+from play_book_downloader.adaptive import save_rate_limiter
+from play_book_downloader.batch import BatchScheduler, log_summary
+from play_book_downloader.book_store import open_book_store, read_image
+from play_book_downloader.journal import PageJournal
+from play_book_downloader.pdf import create_rate_limiter, download_book, read_curl_credentials, \
+    GOOGLE_MAX_REQUESTS_PER_SECOND, GOOGLE_PAGE_DOWNLOAD_WORKERS
+from play_book_downloader.resolution import MAX_RENDERING
+from play_book_downloader.session import create_session
+
+# Magic bytes of the page files, by the extension that mime_to_ext() gave them. JPEG 2000 files all start with the same
+# signature box.
+PAGE_SIGNATURES = {
+    "png": [b"\x89PNG\r\n\x1a\n"],
+    "apng": [b"\x89PNG\r\n\x1a\n"],
+    "jpeg": [b"\xff\xd8\xff"],
+    "jp2": [b"\x00\x00\x00\x0cjP  \r\n\x87\n"],
+    "jpx": [b"\x00\x00\x00\x0cjP  \r\n\x87\n"],
+    "jpm": [b"\x00\x00\x00\x0cjP  \r\n\x87\n"],
+    "bmp": [b"BM"],
+    "webp": [b"RIFF"],
+}
+# A truncated download still has valid headers, but not the marker that ends the image
+PAGE_TRAILERS = {
+    "png": b"IEND\xaeB`\x82",
+    "apng": b"IEND\xaeB`\x82",
+    "jpeg": b"\xff\xd9",
+}
+PIL_FORMATS = {"png": "PNG", "apng": "PNG", "jpeg": "JPEG", "webp": "WEBP", "bmp": "BMP", "jp2": "JPEG2000"}
+
+logging.basicConfig(format="[%(levelname)s] %(message)s")
+logging.getLogger().setLevel(logging.INFO)
+
+
+@click.command()
+@click.argument(
+    "book-base-path",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True, writable=True,
+                    readable=True, path_type=pathlib.Path),
+)
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=os.cpu_count(), show_default=True,
+              help="Number of processes checking the pages.")
+@click.option("--refetch", is_flag=True,
+              help="Download the pages that failed the checks again (reads the credentials from curl.txt).")
+def pdf_verify(book_base_path: pathlib.Path, jobs: int, refetch: bool):
+    """Check that the downloaded pages of the Google Play Book in BOOK-BASE-PATH are intact, before building the PDF.
+
+    Example: play-book-pdf-verify "books/BwCMEAAAQBAJ" --refetch
+
+    Note: like google-play-book-downloader-pdf.py, --refetch has to be run from the folder with curl.txt and books/.
+    """
+    store = open_book_store(book_base_path)
+    try:
+        with store.open("manifest.json") as manifest_file:
+            manifest = json.load(manifest_file)
+        problems = verify_pages(store, manifest, jobs)
+    finally:
+        store.close()
+
+    pages_with_links = {page["pid"] for page in manifest["page"] if page.get("src")}
+    refetchable = [pid for pid in problems if pid in pages_with_links]
+    if problems and refetch and refetchable:
+        refetch_pages(book_base_path, refetchable)
+        store = open_book_store(book_base_path)
+        try:
+            problems = verify_pages(store, manifest, jobs)
+        finally:
+            store.close()
+
+    if problems:
+        logging.error(f"{len(problems)} pages failed the checks:\n" +
+                      "\n".join(f"  {pid}: {problem}" for pid, problem in problems.items()))
+        if not refetch and refetchable:
+            logging.error("Run the same command with --refetch to download them again.")
+        sys.exit(1)
+
+    print(f"All the {len(manifest['page'])} pages are intact.")
+
+
+def verify_pages(store, manifest, jobs=None):
+    """Check the pages of the manifest in a pool of processes. Return the problem of each bad page, by pid."""
+    journal = PageJournal(store)
+    problems = {}
+    pids, images, entries = [], [], []
+
+    for page in manifest["page"]:
+        pid = page.get("pid")
+        entry = journal.entries.get(pid)
+        if not entry:
+            problems[pid] = "not downloaded" if page.get("src") else "not downloaded, its download link is missing"
+            continue
+        try:
+            images.append(store.image(entry["file"]))
+        except FileNotFoundError:
+            problems[pid] = f"{entry['file']} is missing"
+            continue
+        pids.append(pid)
+        entries.append(entry)
+
+    print(f"Checking {len(images)} pages...")
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for pid, problem in zip(pids, executor.map(verify_page, images, entries, chunksize=8)):
+            if problem:
+                problems[pid] = problem
+
+    # In the order of the manifest
+    return {page.get("pid"): problems[page.get("pid")] for page in manifest["page"] if page.get("pid") in problems}
+
+
+def verify_page(image, entry):
+    """Return what is wrong with the page (from the image() method of the book stores) and its journal entry, or None."""
+    try:
+        data = read_image(image)
+    except (OSError, sqlite3.Error) as e:
+        return f"{entry['file']} can't be read: {e}"
+
+    if len(data) != entry["size"] or hashlib.sha256(data).hexdigest() != entry["sha256"]:
+        return f"{entry['file']} doesn't match the journal, it was modified or truncated"
+
+    ext = entry["file"].rsplit(".", 1)[-1]
+    if ext == "unk":
+        return f"{entry['file']} has an unknown content type, e.g. an error page"
+    if ext == "svg":
+        return None if b"<svg" in data[:4096] else f"{entry['file']} isn't an SVG image"
+
+    if not any(data.startswith(signature) for signature in PAGE_SIGNATURES.get(ext, [])):
+        return f"{entry['file']} doesn't start with the magic bytes of a {ext} image (wrong key or not an image)"
+    if ext in PAGE_TRAILERS and PAGE_TRAILERS[ext] not in data[-64:]:
+        return f"{entry['file']} is truncated"
+
+    if ext in PIL_FORMATS:
+        from PIL import Image
+
+        try:
+            with Image.open(io.BytesIO(data), formats=[PIL_FORMATS[ext]]) as decoded:
+                decoded.verify()
+        except Exception as e:
+            return f"{entry['file']} can't be decoded: {e}"
+
+    return None
+
+
+def refetch_pages(book_base_path, pids):
+    """Download the pages again, with the rendering (see choose_rendering()) most of the book was downloaded with."""
+    book_id = pathlib.Path(book_base_path).name
+    if pathlib.Path(book_base_path).resolve() != (pathlib.Path("books") / book_id).resolve():
+        raise click.UsageError("--refetch downloads the pages to books/[BOOK_ID], run it from the folder of books/")
+    store = open_book_store(book_base_path)
+    try:
+        renderings = collections.Counter(json.dumps(entry.get("rendering", MAX_RENDERING), sort_keys=True)
+                                         for entry in PageJournal(store).entries.values())
+    finally:
+        store.close()
+    rendering = json.loads(renderings.most_common(1)[0][0]) if renderings else MAX_RENDERING
+
+    print(f"Downloading {len(pids)} pages again...")
+    cookies, headers = read_curl_credentials()
+    session = create_session(cookies, headers)
+    rate_limiter = create_rate_limiter(cookies, GOOGLE_MAX_REQUESTS_PER_SECOND, GOOGLE_PAGE_DOWNLOAD_WORKERS)
+    scheduler = BatchScheduler(session, rate_limiter, GOOGLE_PAGE_DOWNLOAD_WORKERS)
+
+    def download(book_id, scheduler):
+        return download_book(book_id, scheduler, rendering=rendering, refetch=set(pids))
+
+    try:
+        log_summary(scheduler.run([book_id], download))
+    finally:
+        save_rate_limiter(rate_limiter, cookies)
+
+
+if __name__ == "__main__":
+    pdf_verify()